@@ -1,20 +1,50 @@
-from flask import Flask, g, request, jsonify, abort
-from flask_socketio import SocketIO
+if __name__ == "__main__":  # only the server, CLI commands import app after Flask and threading
+    import eventlet
+    eventlet.monkey_patch()
+
+from flask import Flask, Response, g, request, jsonify, abort
+from flask_socketio import SocketIO, join_room, leave_room, emit
 from flask_cors import CORS
-from requests import post
 from timeit import default_timer as timer
+from concurrent.futures import ProcessPoolExecutor
 
 from db import connect_db, get_categories, get_category_runners, get_runner_by_start_number, get_competition_data, \
-    get_category_startlist, get_category_official_results, query_db, test_conn, STATUS_CODE_SORT
-from oevent2xml import to_xml, punch_xml
+    get_category_startlist, get_category_official_results, get_competition_context, get_competitor_by_chip_number, \
+    get_punches, get_finish_punches_fingerprint, test_conn, to_runner_data, competition_columns, competitor_columns
+from workers import PunchWriter, ExportPool, ExportScheduler, Coalescer
+from cache import ChipIndex, Snapshot
+from leaderboard import LiveResults
+from pool import ConnectionPool, PoolTimeout
+from files import atomic_file, write_file, stats as file_stats
+from feed import Feed
+from hub import Hub, PunchLog
+from codec import encodings, encoding_room, room_encoding, encode_punches, describe
 
 import os
+import re
+import datetime
+import json as json_lib
+import queue
+import atexit
 import time
 import click
 import sqlite3
-import datetime
+
+
+def chunked_input(wsgi_app):
+    """
+    eventlet.wsgi decodes chunked request bodies but does not set `wsgi.input_terminated`, without it
+    werkzeug reads a body without Content-Length as empty.
+    """
+    def middleware(environ, start_response):
+        if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            environ['wsgi.input_terminated'] = True
+        return wsgi_app(environ, start_response)
+    return middleware
+
 
 app = Flask(__name__)
+app.wsgi_app = chunked_input(app.wsgi_app)
 CORS(app)
 socketio = SocketIO(app)
 
@@ -22,13 +52,59 @@ app.config.update(
     DB_USERNAME='SYSDBA',
     DB_PASSWORD='masterkey',
     DB_CONNECTION_STRING='192.168.1.143:C:\\Users\\ASUS-Rok\\AppData\\Roaming\\OEvent\\Data\\Competition13.gdb',
+    DB_POOL_SIZE=8,
+    DB_POOL_TIMEOUT=5,  # s to wait for a free connection
+    DB_POOL_MAX_LIFETIME=1800,  # s
+    DB_POOL_CHECK_AFTER=30,  # s of idle time after which a connection is tested before use
     RESULT_FOLDER='C:\\Users\\rokmo\\liveScoreOut\\',
     SQLITE='punches.db',
     XML_EXPORT=True,
-    XML_EXPORT_WAIT=20,
-    STAGE='1'
+    XML_EXPORT_DEBOUNCE=1,  # s without changes before results.xml is regenerated
+    XML_EXPORT_MAX_LATENCY=5,  # s, results.xml is regenerated at latest after this time while changes keep coming
+    XML_EXPORT_POLL=0.5,  # s between checks for new punches
+    XML_EXPORT_WORKERS=2,
+    XML_WRITER='pyxb',  # 'pyxb' or 'stream'
+    XML_EXPORT_MODE='results',  # 'results' for results.xml, 'classes' for a file per class in RESULT_FOLDER/classes
+    XML_CLASS_WORKERS=None,  # processes serialising classes, None for the number of CPUs
+    XML_GZIP=False,  # also write .xml.gz copies of exported files
+    XML_PUNCH_EXPORT='files',  # 'files' for a <station>_<chip>.xml per punch, 'feed' for RESULT_FOLDER/feed
+    FEED_SEGMENT_BYTES=1048576,  # feed segment is closed at this size
+    FEED_SEGMENT_SECONDS=300,  # s, or at this age
+    FEED_COMPACT_AFTER=3600,  # s after which closed segments are compacted
+    PUNCH_COALESCE_MS=0,  # ms, Socket.IO punches and results deltas are batched per room within this window, 0 disables
+    PUNCH_COALESCE_MAX=100,  # items in one batch
+    PUNCH_LOG_SIZE=10000,  # punches kept for clients catching up after a reconnect
+    STREAM_BUFFER_SIZE=256,  # events buffered per /stream subscriber before it is disconnected
+    STREAM_HISTORY=1000,  # events kept for subscribers resuming with Last-Event-ID
+    STREAM_KEEPALIVE=15,  # s
+    IOF_BINDINGS='iof',  # PyXB bindings module, 'iof_export' when generated with iofgen.py
+    STAGE='1',
+    SNAPSHOT_POLL_INTERVAL=2,  # s between checks for changes in OEvent
+    SNAPSHOT_MAX_AGE=10,  # s, OEvent data served from memory is never older
+    CHIP_INDEX_MAX_AGE=30,  # s, chip swaps made in OEvent are visible at latest after this time
+    PUNCH_DURABILITY='commit',  # 'commit' acks after the punch is committed, 'enqueue' as soon as it is queued
+    PUNCH_COMMIT_INTERVAL=50,  # ms
+    PUNCH_COMMIT_ROWS=500,
+    PUNCH_QUEUE_SIZE=10000,
+    PUNCH_TIMEOUT=5
 )
 
+db_pool = None
+snapshot = None
+punch_writer = None
+punch_exporter = None
+chip_index = None
+live_results = None
+competition_context = None
+class_results = {}  # category id -> (fingerprint, ClassResult xml) of the last results.xml export
+class_files = {}  # category id -> (fingerprint, file name) of the last per class export
+class_executor = None
+punch_feed = None
+stream_hub = None
+coalescer = None
+punch_log = None
+client_encodings = {}  # Socket.IO sid -> encoding chosen by the client, when not JSON
+
 
 @app.cli.command('punch', help='Simulate punch')
 @click.argument('chip')
@@ -40,20 +116,87 @@ def test_punch(chip, station, t):
     else:
         punch_time = int(round(time.time()))
     data = {'chipNumber': chip, 'time': punch_time, 'stationCode': station}
+    from requests import post
     post('http://127.0.0.1:8000/punch', json=data)
     click.echo(data)
 
 
 @app.cli.command('xml_one', help='Generate IOF v3 XML')
 def xml():
-    export_xml()
+    if app.config['XML_EXPORT_MODE'] == 'classes':
+        export_classes(get_db())
+    else:
+        export_xml(get_db())
 
 
-def export_xml():
+def export_xml(conn_fb, class_cache=None):
     results_file = os.path.join(app.config['RESULT_FOLDER'], "results.xml")
-    with open(results_file, "wb") as f:
-        f.write(to_xml(get_db(), get_sqlite(), app.config['STAGE']))
-    print("Saved to: ", results_file)
+    oevent2xml = get_oevent2xml()
+    if app.config['XML_WRITER'] == 'stream':
+        with atomic_file(results_file, app.config['XML_GZIP'], oevent2xml.CREATE_TIME) as f:
+            oevent2xml.write_xml(f, conn_fb, get_sqlite(), app.config['STAGE'])
+        changed = f.changed
+    else:
+        changed = write_file(results_file, oevent2xml.to_xml(conn_fb, get_sqlite(), app.config['STAGE'], class_cache),
+                             app.config['XML_GZIP'], oevent2xml.CREATE_TIME)
+    print("Saved to: " if changed else "Unchanged: ", results_file)
+
+
+def export_classes(conn_fb, class_cache=None):
+    """
+    Writes a ResultList file for each category to RESULT_FOLDER/classes.
+
+    Args:
+        class_cache: dict kept between calls, when given only files of changed categories are written
+    """
+    oevent2xml = get_oevent2xml()
+    stage = app.config['STAGE']
+    competition, categories = oevent2xml.load_categories(conn_fb, get_sqlite(), stage)
+    start_time = oevent2xml.competition_start(competition, stage)
+    fingerprints = {category_id: oevent2xml.class_fingerprint(category, start_time)
+                    for category_id, category in categories.items()}
+    if class_cache is None:
+        class_cache = {}
+    changed = {category_id: category for category_id, category in categories.items()
+               if class_cache.get(category_id, (None,))[0] != fingerprints[category_id]}
+
+    folder = os.path.join(app.config['RESULT_FOLDER'], 'classes')
+    os.makedirs(folder, exist_ok=True)
+    start = timer()
+    documents = oevent2xml.class_result_lists(competition, changed, stage, get_class_executor(),
+                                              app.config['XML_WRITER'])
+    for category_id, (document, _) in documents.items():
+        filename = class_file_name(categories[category_id][0]['CATEGORYNAME'])
+        write_file(os.path.join(folder, filename), document, app.config['XML_GZIP'], oevent2xml.CREATE_TIME)
+        if category_id in class_cache and class_cache[category_id][1] != filename:
+            remove_class_file(folder, class_cache[category_id][1])
+        class_cache[category_id] = (fingerprints[category_id], filename)
+    for category_id in set(class_cache) - set(categories):
+        remove_class_file(folder, class_cache.pop(category_id)[1])
+    elapsed = timer() - start
+
+    serialising = sum(seconds for _, seconds in documents.values())
+    print("Saved {} of {} classes to: {} in {:.2f}s, {:.1f}x speedup over serial export".format(
+        len(documents), len(categories), folder, elapsed, serialising / elapsed if elapsed else 1))
+
+
+def class_file_name(category_name):
+    return re.sub(r'[^\w-]', '_', category_name) + '.xml'
+
+
+def remove_class_file(folder, filename):
+    """ Remove a class file of a renamed or deleted category and its gzip copy. """
+    for path in (os.path.join(folder, filename), os.path.join(folder, filename + '.gz')):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_class_executor():
+    global class_executor
+    if class_executor is None and app.config['XML_CLASS_WORKERS'] != 1:
+        class_executor = ProcessPoolExecutor(app.config['XML_CLASS_WORKERS'])
+        atexit.register(class_executor.shutdown)  # a running pool hangs the monkey patched interpreter at exit
+    return class_executor
 
 
 @app.cli.command('test_db', help='Test DB connection')
@@ -61,17 +204,117 @@ def test_db():
     print("Firebird DB version %s" % test_conn(get_db()))
 
 
-@app.cli.command('xml', help='Constantly generate IOF v3 XMLs')
+@app.cli.command('xml', help='Generate IOF v3 XML whenever punches or OEvent data change')
 def xml_run():
+    scheduler = ExportScheduler(export_results, results_fingerprint,
+                                app.config['XML_EXPORT_DEBOUNCE'],
+                                app.config['XML_EXPORT_MAX_LATENCY'])
+    get_snapshot().on_change(lambda tables: scheduler.trigger())
+    scheduler.start()
+
+    # data_version changes whenever another connection, i.e. the punch writer, commits
+    conn = sqlite3.connect(app.config['SQLITE'])
+    version = None
     while True:
-        try:
-            export_xml()
-        except (SystemExit, KeyboardInterrupt):
-            raise
-        except Exception as exception:
-            print("Failed during update")
-        finally:
-            time.sleep(app.config['XML_EXPORT_WAIT'])
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version != version:
+            version = data_version
+            scheduler.trigger()
+        time.sleep(app.config['XML_EXPORT_POLL'])
+
+
+def export_results():
+    with app.app_context():
+        if app.config['XML_EXPORT_MODE'] == 'classes':
+            export_classes(get_snapshot(), class_files)
+        else:
+            export_xml(get_snapshot(), class_results)
+
+
+def results_fingerprint():
+    with app.app_context():
+        return get_snapshot().version, get_finish_punches_fingerprint(get_sqlite(), app.config['STAGE'])
+
+
+@app.cli.command('bench_punches', help='Benchmark punch lookup on a synthetic event')
+@click.option('--runners', default=5000, help='Number of runners')
+@click.option('--stations', default=3, help='Radio controls per runner')
+def bench_punches(runners, stations):
+    import bench
+    for method, seconds in bench.punch_lookup(runners, stations).items():
+        click.echo('{:<14} {:10.2f}ms'.format(method, seconds * 1000))
+
+
+@app.cli.command('xml_check', help='Check streaming XML writer against the PyXB bindings')
+@click.option('--sample/--oevent', default=True, help='Use a synthetic event or data from OEvent')
+def xml_check(sample):
+    import bench
+    oevent2xml = get_oevent2xml()
+    stage = app.config['STAGE']
+    if sample:
+        competition, categories = bench.synthetic_event(stage=stage)
+    else:
+        competition, categories = oevent2xml.load_categories(get_db(), get_sqlite(), stage)
+    click.echo('conforms: {}'.format(oevent2xml.check_result_list(competition, categories, stage)))
+
+    start = timer()
+    oevent2xml.to_result_list(competition, categories, stage).toxml("utf-8")
+    click.echo('{:<8} {:10.2f}ms'.format('pyxb', (timer() - start) * 1000))
+    start = timer()
+    with open(os.devnull, 'wb') as f:
+        oevent2xml.write_result_list(f, competition, categories, stage)
+    click.echo('{:<8} {:10.2f}ms'.format('stream', (timer() - start) * 1000))
+
+
+@app.cli.command('bench_stream', help='Benchmark /stream fan-out to concurrent subscribers')
+@click.option('--subscribers', default=500, help='Concurrent subscribers')
+@click.option('--events', default=200, help='Published punches')
+def bench_stream(subscribers, events):
+    import bench
+    for name, value in bench.stream_fanout(subscribers, events).items():
+        click.echo('{:<12} {:12.2f}'.format(name, value))
+
+
+@app.cli.command('bench_encoding', help='Benchmark bytes and CPU of punch event encodings')
+@click.option('--punches', default=1000, help='Sent punches')
+@click.option('--subscribers', default=100, help='Clients receiving every punch')
+@click.option('--batch', default=1, help='Punches per message, as with PUNCH_COALESCE_MS')
+def bench_encoding(punches, subscribers, batch):
+    import bench
+    click.echo('{:<10} {:>16} {:>22}'.format('encoding', 'bytes/fan-out', 'CPU ms/1000 fan-outs'))
+    for encoding, (size, cpu) in bench.encoding_fanout(punches, subscribers, batch).items():
+        click.echo('{:<10} {:16.1f} {:22.3f}'.format(encoding, size, cpu))
+
+
+@app.cli.command('bench_tables', help='Benchmark OEvent queries of all columns against used columns')
+@click.option('--repeat', default=5, help='Runs of each query, fastest is reported')
+def bench_tables(repeat):
+    import bench
+    stage = app.config['STAGE']
+    tables = {'OEVLISTSVIEW': competitor_columns(stage), 'OEVCOMPETITION': competition_columns(stage)}
+    click.echo('{:<16} {:>10} {:>10} {:>10} {:>10}'.format('table', 'all', 'bytes', 'used', 'bytes'))
+    for table, (all_seconds, all_size, seconds, size) in bench.table_columns(get_db(), tables, repeat).items():
+        click.echo('{:<16} {:8.2f}ms {:10d} {:8.2f}ms {:10d}'.format(table, all_seconds * 1000, all_size,
+                                                                      seconds * 1000, size))
+
+
+@app.cli.command('bench_startup', help='Benchmark start up time of the app and CLI commands')
+@click.option('--repeat', default=5, help='Runs of each command, fastest is reported')
+def bench_startup(repeat):
+    import bench
+    commands = [name for name in sorted(app.cli.commands) if name != 'bench_startup']
+    for command, seconds in bench.startup(os.path.abspath(__file__), commands, repeat).items():
+        click.echo('{:<24} {:10.2f}ms'.format(command, seconds * 1000))
+
+
+@app.cli.command('bench_bindings', help='Benchmark IOF PyXB binding modules')
+@click.option('--module', '-m', multiple=True, default=['iof'], help='Bindings module, can be repeated')
+def bench_bindings(module):
+    import bench
+    directory = os.path.dirname(os.path.abspath(__file__))
+    click.echo('{:<16} {:>10} {:>14} {:>10}'.format('module', 'import', 'first export', 'memory'))
+    for name, (imported, exported, memory) in bench.bindings(directory, module).items():
+        click.echo('{:<16} {:8.2f}ms {:12.2f}ms {:8.2f}MB'.format(name, imported * 1000, exported * 1000, memory))
 
 
 @app.cli.command('init_db', help='Initialise database')
@@ -85,24 +328,209 @@ def init_db():
 @app.route('/punch', methods=['POST'])
 def punch():
     json = request.get_json()
-    socketio.emit('new_punch', json)
+    try:
+        normalise_punch(json)
+    except (TypeError, ValueError):
+        abort(400)
+    store_punches([json])  # clients only see punches that were stored
+    print(json)
+    event = punch_event(json)
+    get_punch_log().append(event)
+    emit_punches([event])
+    stream_punches([event])
+    apply_punches([json])
+
+    if app.config['XML_EXPORT']:
+        get_punch_exporter().submit(json)
+    return '', 200
+
+
+@app.route('/punches', methods=['POST'])
+def punches():
+    """ Bulk punch upload, body is a JSON array or newline delimited JSON objects. """
+    if request.mimetype in ('application/x-ndjson', 'application/jsonlines'):
+        items = read_ndjson(request.stream)
+    else:
+        items = request.get_json()
+        if not isinstance(items, list):
+            abort(400)
 
+    accepted = []
+    status = []
+    for item in items:
+        try:
+            if isinstance(item, Exception):
+                raise item
+            normalise_punch(item)
+        except (TypeError, ValueError) as exception:
+            status.append({'status': 'error', 'error': str(exception)})
+        else:
+            accepted.append(item)
+            status.append({'status': 'ok'})
+    if not status:
+        abort(400)  # empty body, or one the server could not read
+
+    if accepted:
+        store_punches(accepted)
+        events = [punch_event(item) for item in accepted]
+        for event in events:
+            get_punch_log().append(event)
+        emit_punches(events, batch=True)
+        stream_punches(events)
+        print('Stored {} punches'.format(len(accepted)))
+        apply_punches(accepted)
+
+        if app.config['XML_EXPORT']:
+            for item in accepted:
+                get_punch_exporter().submit(item)
+    return jsonify(status), 200
+
+
+@app.route('/punches', methods=['GET'])
+def punches_since():
+    """ Punches with seq above `since` still kept in memory, see `PunchLog.since`. """
+    limit = request.args.get('limit', None, type=int)
+    if limit is not None and limit < 0:
+        abort(400)
+    return jsonify(get_punch_log().since(request.args.get('since', 0, type=int), limit,
+                                         request.args.get('instance')))
+
+
+def read_ndjson(stream):
+    for line in iter(stream.readline, b''):  # iterating eventlet's input yields chunks, not lines
+        line = line.strip()
+        if line:
+            try:
+                yield json_lib.loads(line.decode('utf-8'))
+            except ValueError as exception:
+                yield exception
+
+
+def normalise_punch(json):
+    for key in ('chipNumber', 'time', 'stationCode'):
+        if key not in json:
+            raise ValueError('missing ' + key)
+    json['chipNumber'] = int(json['chipNumber'])  # raises TypeError for null
+    json['time'] = int(json['time'])
     json['stationCode'] = int(json['stationCode'])
     if json['stationCode'] < 10:  # below 10 is reserved as finish station
         json['stationCode'] = 0
 
-    sql = '''INSERT OR REPLACE INTO punches(chipNumber, stationCode, time, stage) VALUES (?,?,?,?)'''
-    conn = get_sqlite()
-    cur = conn.cursor()
-    cur.execute(sql, (json['chipNumber'], json['stationCode'], json['time'], app.config['STAGE']))
-    conn.commit()
-    print(json)
 
-    if app.config['XML_EXPORT']:
-        filename = str(json['stationCode']) + "_" + str(json['chipNumber']) + ".xml"
-        with open(os.path.join(app.config['RESULT_FOLDER'], filename), "wb") as f:
-            f.write(punch_xml(get_db(), json['chipNumber'], json['stationCode'], json['time'], app.config['STAGE']))
-    return '', 200
+def punch_event(json):
+    """ Socket.IO punch payload, `json` extended with runner data from the chip index. """
+    event = dict(json)
+    stage = app.config['STAGE']
+    try:
+        for competitor in get_chip_index().get(json['chipNumber']):
+            if competitor['ISRUNNING' + stage]:
+                event['runner'] = to_punch_runner(competitor, json['time'])
+                break
+    except Exception as exception:
+        print("Runner lookup failed: ", exception)
+    return event
+
+
+def emit_coalesced(event, batch_event, data, room=None):
+    """
+    Emit `data` as `event` to Socket.IO clients in `room`, with PUNCH_COALESCE_MS data is batched with
+    other data for the room and emitted as a list in `batch_event`.
+    """
+    if get_coalescer() is None:
+        socketio.emit(event, data, room=room)
+    else:
+        get_coalescer().add(batch_event, room, data)
+
+
+def emit_punches(events, batch=False):
+    """
+    Emit punch events to Socket.IO clients of each encoding. JSON clients get a `new_punch` per event unless
+    `batch` or coalescing, clients of compact encodings get `punches` with events encoded as binary.
+    """
+    for encoding in set(client_encodings.values()) | {'json'}:
+        room = encoding_room(encoding)
+        if get_coalescer() is not None:
+            for event in events:
+                get_coalescer().add('punches', room, event)
+        elif encoding == 'json' and not batch:
+            for event in events:
+                socketio.emit('new_punch', event, room=room)
+        else:
+            emit_batch('punches', events, room)
+
+
+def emit_batch(event, items, room):
+    """ Emit `items` to `room`, encoded as binary for rooms of compact encodings. """
+    encoding = room_encoding(room)
+    if encoding is not None and encoding != 'json':
+        items = encode_punches(encoding, items)
+    socketio.emit(event, items, room=room)
+
+
+def stream_punches(events):
+    """ Publish punch events to /stream subscribers of the runner's category. """
+    hub = get_stream_hub()
+    for event in events:
+        hub.publish('punch', event['runner']['category'] if 'runner' in event else None, event)
+
+
+def to_punch_runner(competitor, punch_time):
+    runner = to_runner_data(competitor, app.config['STAGE'])
+    runner['category'] = competitor['CATEGORYNAME']
+    if 'startTime' in runner:
+        runner['runningTime'] = relative_time(punch_time, runner['startTime'], get_context())
+    return runner
+
+
+def apply_punches(punches):
+    """ Update in-memory state derived from punches. """
+    for json in punches:
+        try:
+            update_results(json)
+        except Exception as exception:
+            print("Live results update failed: ", exception)
+
+
+def store_punches(punches):
+    """ Queue `punches` as one write and, depending on PUNCH_DURABILITY, wait for the commit. """
+    rows = [(p['chipNumber'], p['stationCode'], p['time'], app.config['STAGE']) for p in punches]
+    try:
+        pending = get_punch_writer().submit(rows, app.config['PUNCH_TIMEOUT'])
+    except queue.Full:
+        abort(503)
+    if app.config['PUNCH_DURABILITY'] == 'commit' and not pending.wait(app.config['PUNCH_TIMEOUT']):
+        abort(503)
+
+
+def export_punch(json):
+    with app.app_context():
+        if app.config['XML_PUNCH_EXPORT'] == 'feed':
+            append_punch_feed(json)
+        else:
+            write_punch_xml(json)
+
+
+def append_punch_feed(json):
+    fragments = get_oevent2xml().punch_fragments(get_snapshot(), json['chipNumber'], json['stationCode'], json['time'],
+                                                 app.config['STAGE'], get_chip_index().get(json['chipNumber']))
+    get_punch_feed().append([{'chipNumber': json['chipNumber'],
+                              'stationCode': json['stationCode'],
+                              'time': json['time'],
+                              'className': class_name,
+                              'personResult': person_result} for class_name, person_result in fragments])
+
+
+def write_punch_xml(json):
+    filename = str(json['stationCode']) + "_" + str(json['chipNumber']) + ".xml"
+    args = (get_snapshot(), json['chipNumber'], json['stationCode'], json['time'], app.config['STAGE'],
+            get_chip_index().get(json['chipNumber']))
+    oevent2xml = get_oevent2xml()
+    path = os.path.join(app.config['RESULT_FOLDER'], filename)
+    if app.config['XML_WRITER'] == 'stream':
+        with atomic_file(path, app.config['XML_GZIP'], oevent2xml.CREATE_TIME) as f:
+            oevent2xml.write_punch_xml(f, *args)
+    else:
+        write_file(path, oevent2xml.punch_xml(*args), app.config['XML_GZIP'], oevent2xml.CREATE_TIME)
 
 
 def calc_seconds(time_string):
@@ -111,12 +539,12 @@ def calc_seconds(time_string):
 
 @app.route('/categories', methods=['GET'])
 def list_categories():
-    return jsonify(get_categories(get_db()))
+    return jsonify(get_categories(get_snapshot()))
 
 
 @app.route('/runner/<start_number>', methods=['GET'])
 def list_runner(start_number):
-    runner_data = augment_runners(get_runner_by_start_number(get_db(), start_number, app.config['STAGE']))
+    runner_data = augment_runners(get_runner_by_start_number(get_snapshot(), start_number, app.config['STAGE']))
     if not runner_data:
         abort(404)
 
@@ -125,7 +553,7 @@ def list_runner(start_number):
 
 @app.route('/category/<category_id>/runners', methods=['GET'])
 def list_category_runners(category_id):
-    return jsonify(augment_runners(get_category_runners(get_db(), category_id, app.config['STAGE'])))
+    return jsonify(augment_runners(get_category_runners(get_snapshot(), category_id, app.config['STAGE'])))
 
 
 @app.route('/category/<category_id>/results', methods=['GET'])
@@ -135,15 +563,12 @@ def list_category_results(category_id):
     else:
         s = 0
 
-    runners = sorted(
-        (runner for runner in augment_runners(get_category_runners(get_db(), category_id, app.config['STAGE'])) if s in runner['punches']),
-        # key=lambda r: r['punches'][s]['time'])
-        key=lambda r: sort_results(r, s))
-    return jsonify([extract_time(runner, s) for runner in runners])
+    return jsonify(get_live_results().results(category_id, s))
 
 
-def sort_results(r, s):
-    return STATUS_CODE_SORT[r['finishType']], r['punches'][s]['time']
+def load_results(category_id, s):
+    runners = augment_runners(get_category_runners(get_snapshot(), category_id, app.config['STAGE']))
+    return [extract_time(runner, s) for runner in runners if s in runner['punches']]
 
 
 def extract_time(runner, s):
@@ -152,50 +577,340 @@ def extract_time(runner, s):
     return runner
 
 
+def update_results(json):
+    """ Apply punch to live results of the runner's category. """
+    stage = app.config['STAGE']
+    for competitor in get_chip_index().get(json['chipNumber']):
+        if competitor['ISRUNNING' + stage]:
+            entry = to_runner_data(competitor, stage)
+            if 'startTime' in entry:
+                entry['competitionTime'] = relative_time(json['time'], entry['startTime'], get_context())
+                category, station = competitor['CATEGORYNAME'], json['stationCode']
+                changed = get_live_results().update(category, station, entry)
+                delta = get_live_results().delta(category, station, entry, changed)
+                emit_coalesced('results_delta', 'results_deltas', delta, results_room(category, station))
+                emit_coalesced('results_delta', 'results_deltas', delta, results_room(category))
+                get_stream_hub().publish('results_delta', category, delta)
+
+
+def results_room(category, station=None):
+    if station is None:
+        return 'category:' + str(category)
+    return 'category:{}:{}'.format(category, station)
+
+
+@socketio.on('connect')
+def connect():
+    join_room(encoding_room('json'))
+
+
+@socketio.on('disconnect')
+def disconnect():
+    client_encodings.pop(request.sid, None)
+
+
+@socketio.on('encoding')
+def choose_encoding(data):
+    """ Switch punch events of the client to `encoding`, the reply describes its layout. """
+    encoding = data.get('encoding', 'json')
+    if encoding not in encodings():
+        emit('encoding', {'error': 'unknown encoding', 'encodings': encodings()})
+        return
+    leave_room(encoding_room(client_encodings.pop(request.sid, 'json')))
+    join_room(encoding_room(encoding))
+    if encoding != 'json':
+        client_encodings[request.sid] = encoding
+    emit('encoding', describe(encoding))
+
+
+@socketio.on('subscribe')
+def subscribe(data):
+    """ Join room with results deltas of a category, or of one station in it if `station` is given. """
+    station = data.get('station')
+    if station is not None:
+        station = int(station)
+    join_room(results_room(data['category'], station))
+    if station is not None:
+        emit('results', {'category': data['category'],
+                         'station': station,
+                         'results': get_live_results().results(data['category'], station)})
+
+
+@socketio.on('unsubscribe')
+def unsubscribe(data):
+    station = data.get('station')
+    leave_room(results_room(data['category'], None if station is None else int(station)))
+
+
+@socketio.on('resync')
+def resync(data):
+    """ Send punches the client missed, `since` is the last seq it received. """
+    data = data if isinstance(data, dict) else {}
+    try:
+        since = int(data.get('since', 0))
+        limit = None if data.get('limit') is None else int(data['limit'])
+        if limit is not None and limit < 0:
+            raise ValueError('negative limit')
+    except (TypeError, ValueError):
+        emit('resync', {'error': 'since must be an integer and limit a non-negative integer'})
+        return
+    emit('resync', get_punch_log().since(since, limit, data.get('instance')))
+
+
+@app.route('/stream', methods=['GET'])
+def stream():
+    """
+    Server-Sent Events `punch` and `results_delta` of categories given with `category`, of all when not given.
+
+    A reconnecting client sends `Last-Event-ID`, or `lastEventId` parameter, and gets the events it missed.
+    """
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('lastEventId'))
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        abort(400)
+    hub = get_stream_hub()
+    subscriber = hub.subscribe(request.args.getlist('category'), last_event_id)
+    return Response(hub.stream(subscriber, app.config['STREAM_KEEPALIVE']), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/category/<category_id>/startList', methods=['GET'])
 def startlist_category(category_id):
-    return jsonify(get_category_startlist(get_db(), category_id, app.config['STAGE']))
+    return jsonify(get_category_startlist(get_snapshot(), category_id, app.config['STAGE']))
 
 
 @app.route('/category/<category_id>/officialResults', methods=['GET'])
 def official_results_category(category_id):
-    return jsonify(get_category_official_results(get_db(), category_id, app.config['STAGE']))
+    return jsonify(get_category_official_results(get_snapshot(), category_id, app.config['STAGE']))
+
+
+@app.errorhandler(PoolTimeout)
+def db_busy(error):
+    return 'OEvent database busy', 503
+
+
+@app.route('/debug/stats', methods=['GET'])
+def debug_stats():
+    stats = {}
+    if db_pool is not None:
+        stats['firebirdPool'] = db_pool.stats()
+    if snapshot is not None:
+        stats['snapshot'] = snapshot.stats()
+    if punch_writer is not None:
+        stats['punchWriter'] = punch_writer.stats()
+    if punch_exporter is not None:
+        stats['xmlExport'] = punch_exporter.stats()
+    if chip_index is not None:
+        stats['chipIndex'] = chip_index.stats()
+    if live_results is not None:
+        stats['liveResults'] = live_results.stats()
+    if punch_feed is not None:
+        stats['feed'] = punch_feed.stats()
+    if stream_hub is not None:
+        stats['stream'] = stream_hub.stats()
+    if coalescer is not None:
+        stats['coalescer'] = coalescer.stats()
+    if punch_log is not None:
+        stats['punchLog'] = {'seq': punch_log.seq}
+    stats['encodings'] = {encoding: list(client_encodings.values()).count(encoding) for encoding in encodings()
+                          if encoding != 'json'}
+    stats['files'] = file_stats()
+    return jsonify(stats)
+
+
+@app.route('/feed', methods=['GET'])
+def read_feed():
+    """ Exported punches after sequence number `since`, when XML_PUNCH_EXPORT is 'feed'. """
+    since = request.args.get('since', 0, type=int)
+    records = get_punch_feed().read(since, request.args.get('limit', 1000, type=int))
+    return jsonify({'records': records, 'last': records[-1]['seq'] if records else since})
 
 
 @app.route('/competition', methods=['GET'])
 def list_competition_date():
-    return jsonify(get_competition_data(get_db(), app.config['STAGE']))
+    return jsonify(get_competition_data(get_snapshot(), app.config['STAGE']))
 
 
 def augment_runners(runners):
+    context = get_context()
+    punches = get_punches(get_sqlite(), app.config['STAGE'], {runner['siCardNumber'] for runner in runners})
     for runner in runners:
-        runner['punches'] = list_punches(runner['siCardNumber'], runner['startTime'])
+        runner['punches'] = {d[1]: punch_dict(d, runner['startTime'], context)
+                             for d in punches.get(str(runner['siCardNumber']), ())}
     return runners
 
 
-def list_punches(chip_number, start_time):
-    data = query_db(get_sqlite(), 'SELECT * FROM punches WHERE chipNumber = ? AND stage = ?', (chip_number, app.config['STAGE']))
-    return {d[1]: punch_dict(d, start_time) for d in data}
+def punch_dict(d, start_time, context):
+    return {'chipNumber': d[0], 'time': relative_time(d[3], start_time, context)}
 
 
-def punch_dict(d, start_time):
-    midnight = datetime.datetime.combine(datetime.datetime.today(), datetime.time.min)
-    midnight_unix = time.mktime(midnight.timetuple())
-    first_start = get_competition_data(get_db(), app.config['STAGE'])['firstStart']
-    return {'chipNumber': d[0], 'time': d[3] - first_start - start_time - midnight_unix}
+def relative_time(punch_time, start_time, context):
+    """ Seconds from runner's start to unix `punch_time`. """
+    return punch_time - context.first_start - start_time - context.midnight
 
 
 def get_db():
     start = timer()
     db = getattr(g, 'firebird_db', None)
     if db is None:
-        db = g.firebird_db = connect_db(app.config['DB_CONNECTION_STRING'],
-                                        app.config['DB_USERNAME'],
-                                        app.config['DB_PASSWORD'])
+        db = g.firebird_db = get_db_pool().acquire()
     print('DB CONN {:.4f}ms'.format((timer() - start) * 1000))
     return db
 
 
+def get_db_pool():
+    global db_pool
+    if db_pool is None:
+        db_pool = ConnectionPool(lambda: connect_db(app.config['DB_CONNECTION_STRING'],
+                                                    app.config['DB_USERNAME'],
+                                                    app.config['DB_PASSWORD']),
+                                 test_conn,
+                                 app.config['DB_POOL_SIZE'],
+                                 app.config['DB_POOL_TIMEOUT'],
+                                 app.config['DB_POOL_MAX_LIFETIME'],
+                                 app.config['DB_POOL_CHECK_AFTER'])
+        atexit.register(db_pool.close)
+    return db_pool
+
+
+def get_punch_writer():
+    global punch_writer
+    if punch_writer is None:
+        punch_writer = PunchWriter(app.config['SQLITE'],
+                                   app.config['PUNCH_COMMIT_INTERVAL'] / 1000,
+                                   app.config['PUNCH_COMMIT_ROWS'],
+                                   app.config['PUNCH_QUEUE_SIZE'])
+        punch_writer.start()
+        atexit.register(punch_writer.stop)
+    return punch_writer
+
+
+def get_punch_exporter():
+    global punch_exporter
+    if punch_exporter is None:
+        # a newer punch of a chip at a station replaces its queued export, they write the same file
+        punch_exporter = ExportPool(export_punch,
+                                    app.config['XML_EXPORT_WORKERS'],
+                                    lambda json: (json['stationCode'], json['chipNumber']))
+        punch_exporter.start()
+        atexit.register(punch_exporter.stop)
+    return punch_exporter
+
+
+def get_coalescer():
+    global coalescer
+    if coalescer is None and app.config['PUNCH_COALESCE_MS']:
+        coalescer = Coalescer(emit_batch,
+                              app.config['PUNCH_COALESCE_MS'] / 1000,
+                              app.config['PUNCH_COALESCE_MAX'])
+        coalescer.start()
+    return coalescer
+
+
+def get_punch_log():
+    global punch_log
+    if punch_log is None:
+        punch_log = PunchLog(app.config['PUNCH_LOG_SIZE'])
+    return punch_log
+
+
+def get_stream_hub():
+    global stream_hub
+    if stream_hub is None:
+        stream_hub = Hub(app.config['STREAM_BUFFER_SIZE'], app.config['STREAM_HISTORY'])
+    return stream_hub
+
+
+def get_punch_feed():
+    global punch_feed
+    if punch_feed is None:
+        punch_feed = Feed(os.path.join(app.config['RESULT_FOLDER'], 'feed'),
+                          app.config['FEED_SEGMENT_BYTES'],
+                          app.config['FEED_SEGMENT_SECONDS'],
+                          app.config['FEED_COMPACT_AFTER'])
+        atexit.register(punch_feed.close)
+    return punch_feed
+
+
+def get_oevent2xml():
+    """ oevent2xml is imported on first use, IOF bindings are slow to import """
+    import oevent2xml
+    oevent2xml.BINDINGS = app.config['IOF_BINDINGS']
+    return oevent2xml
+
+
+def get_chip_index():
+    global chip_index
+    if chip_index is None:
+        chip_index = ChipIndex(load_competitors, load_competitor,
+                               'CHIPNUMBER' + app.config['STAGE'],
+                               app.config['CHIP_INDEX_MAX_AGE'])
+    return chip_index
+
+
+def get_snapshot():
+    global snapshot
+    if snapshot is None:
+        stage = app.config['STAGE']
+        snapshot = Snapshot(get_db_pool().connection,
+                            {'OEVLISTSVIEW': competitor_columns(stage),
+                             'OEVCATEGORY': ('CATEGORYNAME',),
+                             'OEVCOMPETITION': competition_columns(stage)},
+                            app.config['SNAPSHOT_POLL_INTERVAL'],
+                            app.config['SNAPSHOT_MAX_AGE'])
+        snapshot.on_change(snapshot_changed)
+        snapshot.start()
+    return snapshot
+
+
+def snapshot_changed(tables):
+    if 'OEVCOMPETITION' in tables:
+        invalidate_context()
+    if 'OEVLISTSVIEW' in tables and chip_index is not None:
+        chip_index.refresh()
+    if live_results is not None:
+        live_results.clear()
+
+
+def get_live_results():
+    global live_results
+    if live_results is None:
+        live_results = LiveResults(load_results)
+    return live_results
+
+
+def get_context():
+    global competition_context
+    # punch times are relative to today's midnight, a server running over midnight needs the new one
+    if competition_context is None or competition_context.day != datetime.date.today():
+        competition_context = get_competition_context(get_snapshot(), app.config['STAGE'])
+    return competition_context
+
+
+def invalidate_context():
+    global competition_context
+    competition_context = None
+
+
+def warm_caches():
+    try:
+        get_snapshot().poll()
+        get_context()
+        get_chip_index().refresh()
+    except Exception as exception:
+        print("Failed to load OEvent data: ", exception)
+
+
+def load_competitors():
+    return get_snapshot().rows('OEVLISTSVIEW')
+
+
+def load_competitor(chip_number):
+    with get_db_pool().connection() as conn:
+        return get_competitor_by_chip_number(conn, chip_number, app.config['STAGE'])
+
+
 def get_sqlite():
     db = getattr(g, 'sqlite_db', None)
     if db is None:
@@ -206,10 +921,11 @@ def get_sqlite():
 @app.teardown_appcontext
 def close_db(error):
     if hasattr(g, 'firebird_db'):
-        g.firebird_db.close()
+        get_db_pool().release(g.firebird_db)
     if hasattr(g, 'sqlite_db'):
         g.sqlite_db.close()
 
 
 if __name__ == "__main__":
+    warm_caches()
     socketio.run(app, host='0.0.0.0', port=8000)
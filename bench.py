@@ -0,0 +1,277 @@
+""" Benchmarks for `flask bench_*` commands """
+
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from timeit import default_timer as timer
+
+from db import get_punches, query_db
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+
+
+def synthetic_punches(database, runners, stations, stage='1'):
+    """ Punches database for `runners` competitors punching `stations` controls and the finish. """
+    conn = sqlite3.connect(database)
+    with open(SCHEMA) as f:
+        conn.executescript(f.read())
+    rows = [(chip, station, stage, 36000 + random.randint(0, 7200))
+            for chip in range(100000, 100000 + runners)
+            for station in [0] + list(range(100, 100 + stations))]
+    conn.executemany('INSERT INTO punches(chipNumber, stationCode, stage, time) VALUES (?,?,?,?)', rows)
+    conn.commit()
+    return conn
+
+
+def punch_lookup(runners=5000, stations=3, category_size=200, stage='1'):
+    """
+    Compares a query per runner with one batched query per category and one query per stage.
+
+    Returns:
+        dict: method -> seconds to fetch punches of all runners
+    """
+    database = os.path.join(tempfile.mkdtemp(), 'punches.db')
+    conn = synthetic_punches(database, runners, stations, stage)
+    chips = list(range(100000, 100000 + runners))
+    categories = [chips[i:i + category_size] for i in range(0, runners, category_size)]
+    timings = {}
+
+    start = timer()
+    for chip in chips:
+        query_db(conn, 'SELECT * FROM punches WHERE chipNumber = ? AND stage = ?', (chip, stage))
+    timings['per runner'] = timer() - start
+
+    start = timer()
+    for category in categories:
+        get_punches(conn, stage, category)
+    timings['per category'] = timer() - start
+
+    start = timer()
+    get_punches(conn, stage)
+    timings['per stage'] = timer() - start
+
+    conn.close()
+    os.remove(database)
+    os.rmdir(os.path.dirname(database))
+    return timings
+
+
+def synthetic_event(categories=40, runners=50, stage='1'):
+    """
+    Competition and competitors in the shape of OEVENT rows, covering every finish type, runners without club,
+    names that need escaping, radio control and finish punches.
+
+    Returns:
+        tuple: competition data, dict of category id -> competitors
+    """
+    competition = {'COMPETITIONNAME': 'Synthetic <event> & "co"',
+                   'DATE' + stage: datetime(2017, 6, 7),
+                   'FIRSTSTART' + stage: 36000}
+    first_start = datetime(2017, 6, 7, 10).timestamp()
+    event = defaultdict(list)
+    for category in range(categories):
+        for runner in range(runners):
+            start_time = runner * 6000 + random.choice((0, 50))
+            competitor = {'STARTNUMBER': category * 1000 + runner,
+                          'FIRSTNAME': random.choice(('Ana', 'Žiga', "D'Arcy", '')),
+                          'LASTNAME': random.choice(('Novak', 'Smith & Sons', '<Müller>')),
+                          'CLUBLONGNAME': random.choice(('OK Ljubljana', 'OK "Azimut"', None)),
+                          'CLUBSHORTNAME': random.choice(('OKL', None)),
+                          'CATEGORYID': category,
+                          'CATEGORYNAME': 'M{}'.format(category),
+                          'FINISHTYPE' + stage: random.randint(0, 5),
+                          'STARTTIME' + stage: start_time,
+                          'COMPETITIONTIME' + stage: random.choice((None, random.randint(180000, 720000)))}
+            punch = random.choice((None, 0, 31, 100))
+            if punch is not None:
+                competitor['SPLITTIME'] = (punch, first_start + start_time / 100 + random.randint(600, 7200))
+            event[category].append(competitor)
+    return competition, event
+
+
+def startup(app_file, commands, repeat=5):
+    """
+    Time to import the app module in a new interpreter and to start each CLI command with `--help`,
+    which loads the app and the command without running it.
+
+    Returns:
+        dict: command -> fastest of `repeat` runs in seconds
+    """
+    env = dict(os.environ, FLASK_APP=app_file)
+    runs = [('import app', [sys.executable, '-c', 'import app'])]
+    runs += [(command, [sys.executable, '-m', 'flask', command, '--help']) for command in commands]
+    timings = {}
+    for name, args in runs:
+        best = None
+        for _ in range(repeat):
+            start = timer()
+            subprocess.run(args, cwd=os.path.dirname(app_file), env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            seconds = timer() - start
+            best = seconds if best is None else min(best, seconds)
+        timings[name] = best
+    return timings
+
+
+BINDINGS_RUN = """
+import sys, time, tracemalloc
+sys.path.insert(0, {directory!r})
+import bench, oevent2xml
+oevent2xml.BINDINGS = {module!r}
+competition, categories = bench.synthetic_event(1, 10)
+if {trace}:
+    tracemalloc.start()
+start = time.perf_counter()
+oevent2xml.bindings()
+imported = time.perf_counter()
+oevent2xml.to_result_list(competition, categories, '1').toxml('utf-8')
+print(imported - start, time.perf_counter() - imported, tracemalloc.get_traced_memory()[1] if {trace} else 0)
+"""
+
+
+def bindings(directory, modules, repeat=3):
+    """
+    Compares PyXB binding modules, each in a new interpreter as bindings of one namespace can not be loaded twice.
+
+    Returns:
+        dict: module -> (import seconds, seconds of the first export, peak MB allocated while importing)
+    """
+    results = {}
+    for module in modules:
+        timings = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', BINDINGS_RUN.format(directory=directory, module=module,
+                                                                                trace=False)],
+                                    stdout=subprocess.PIPE, check=True).stdout
+            timings.append([float(value) for value in output.split()])
+        output = subprocess.run([sys.executable, '-c', BINDINGS_RUN.format(directory=directory, module=module,
+                                                                            trace=True)],
+                                stdout=subprocess.PIPE, check=True).stdout
+        peak = float(output.split()[2]) / 2 ** 20
+        results[module] = (min(t[0] for t in timings), min(t[1] for t in timings), peak)
+    return results
+
+
+def stream_fanout(subscribers=500, events=200, categories=10, buffer_size=256):
+    """
+    Publishes punch events to `subscribers` SSE streams, each subscribed to one of `categories`,
+    consumed by a native thread per subscriber.
+
+    Returns:
+        dict: deliveries, seconds until every subscriber got its events, deliveries per second, evicted subscribers
+    """
+    from hub import Hub
+    hub = Hub(buffer_size, events)
+    expected = events // categories
+    done = threading.Barrier(subscribers + 1)
+
+    def consume(subscriber):
+        received = 0
+        stream = hub.stream(subscriber, keepalive=1)
+        for chunk in stream:
+            if chunk.startswith(b'id:'):
+                received += 1
+                if received == expected:
+                    break
+        stream.close()
+        done.wait()
+
+    for i in range(subscribers):
+        subscriber = hub.subscribe(['M{}'.format(i % categories)])
+        threading.Thread(target=consume, args=(subscriber,), daemon=True).start()
+
+    event = {'chipNumber': 100000, 'stationCode': 100, 'time': 36000,
+             'runner': {'startNumber': 1, 'firstName': 'Ana', 'lastName': 'Novak', 'runningTime': 1234}}
+    start = timer()
+    for i in range(events):
+        hub.publish('punch', 'M{}'.format(i % categories), event)
+        time.sleep(0)  # let subscribers run as they would between requests
+    done.wait()
+    seconds = timer() - start
+    deliveries = subscribers * expected
+    return {'deliveries': deliveries, 'seconds': seconds, 'per second': deliveries / seconds,
+            'evicted': hub.evicted}
+
+
+def punch_events(count):
+    """ Socket.IO punch events as sent by /punch, with runner data and seq """
+    return [{'chipNumber': 100000 + i, 'stationCode': 100 + i % 10, 'time': 1496822400 + i, 'seq': i + 1,
+             'runner': {'startNumber': i, 'name': 'Ana Novak', 'siCardNumber': 100000 + i, 'finishType': 'OK',
+                        'club': 'OK Ljubljana', 'country': 'SLO', 'startTime': 360.0, 'category': 'M21',
+                        'runningTime': 1234}}
+            for i in range(count)]
+
+
+def encoding_fanout(punches=1000, subscribers=100, batch=1):
+    """
+    Sends `punches` to `subscribers` in every available encoding, `batch` punches per message, the Socket.IO
+    packet is encoded once per message and the encoded engine.io packets are sent to every subscriber.
+
+    Returns:
+        dict: encoding -> (bytes on the wire per fan-out, CPU ms per 1000 fan-outs), a fan-out is one punch
+            delivered to one subscriber, websocket frame headers included
+    """
+    from socketio import packet
+    from engineio import packet as eio_packet
+    import codec
+
+    events = punch_events(punches)
+    fanouts = punches * subscribers
+    results = {}
+    for encoding in codec.encodings():
+        wire = 0
+        start = time.process_time()
+        for i in range(0, punches, batch):
+            items = events[i:i + batch]
+            if encoding == 'json':
+                message = ['new_punch', items[0]] if batch == 1 else ['punches', items]
+            else:
+                message = ['punches', codec.encode_punches(encoding, items)]
+            encoded = packet.Packet(packet.EVENT, data=message).encode()
+            frames = [eio_packet.Packet(eio_packet.MESSAGE, p) for p in (encoded if isinstance(encoded, list)
+                                                                         else [encoded])]
+            for _ in range(subscribers):
+                for frame in frames:
+                    data = frame.encode()
+                    size = len(data) if isinstance(data, bytes) else len(data.encode('utf-8'))
+                    wire += size + (2 if size < 126 else 4)
+        seconds = time.process_time() - start
+        results[encoding] = (wire / fanouts, seconds * 1000 / fanouts * 1000)
+    return results
+
+
+def table_columns(conn, tables, repeat=5):
+    """
+    Fetches each table with `SELECT *` and with its column list, fastest of `repeat` runs.
+
+    Args:
+        conn: Firebird connection
+        tables: dict of table -> columns used by the app
+    Returns:
+        dict: table -> (all columns seconds, bytes, listed columns seconds, bytes), bytes are the size
+            of fetched values as text, an estimate of what is sent over the wire
+    """
+    def fetch(sql):
+        best, size = None, 0
+        for _ in range(repeat):
+            start = timer()
+            cur = conn.cursor()
+            cur.execute(sql)
+            rows = cur.fetchall()
+            cur.close()
+            seconds = timer() - start
+            best = seconds if best is None else min(best, seconds)
+            size = sum(len(str(value)) for row in rows for value in row if value is not None)
+        return best, size
+
+    results = {}
+    for table, columns in tables.items():
+        results[table] = fetch('SELECT * FROM ' + table) + fetch('SELECT {} FROM {}'.format(','.join(columns), table))
+    return results
@@ -0,0 +1,191 @@
+""" In-memory caches of OEVENT data """
+
+import threading
+import time
+
+from db import get_table, get_fingerprint, filter_rows
+
+
+class Snapshot(object):
+    """
+    In-memory copy of OEVENT tables, kept up to date by a single background poller.
+
+    Every `interval` seconds the poller reads a cheap fingerprint (row count and checksum) of each table
+    and reloads only the tables whose fingerprint changed. Reads are served from memory, if the last
+    successful poll is older than `max_age` seconds the reader polls the database itself.
+    Can be passed instead of a connection to the `db` query functions.
+    """
+
+    def __init__(self, connection, tables, interval=2, max_age=10):
+        """
+        Args:
+            connection: callable returning a context manager which yields a Firebird connection
+            tables: dict of table name -> columns kept in memory and used for the fingerprint
+            interval: seconds between polls
+            max_age: maximal age of served data in seconds
+        """
+        self.connection = connection
+        self.tables = tables
+        self.interval = interval
+        self.max_age = max_age
+        self.checked = None
+        self.polls = 0
+        self.reloads = 0
+        self.version = 0
+        self._rows = {}
+        self._fingerprints = {}
+        self._listeners = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def on_change(self, listener):
+        """ Call `listener` with the set of reloaded table names after each poll that changed data. """
+        self._listeners.append(listener)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='oevent-snapshot')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as exception:
+                print("OEvent poll failed: ", exception)
+            time.sleep(self.interval)
+
+    def poll(self):
+        """ Reload tables that changed since the last poll. """
+        with self._lock:
+            changed = self._poll()
+        self._notify(changed)
+
+    def _poll(self):
+        changed = set()
+        with self.connection() as conn:
+            for table, columns in self.tables.items():
+                fingerprint = get_fingerprint(conn, table, columns)
+                if table not in self._rows or fingerprint != self._fingerprints.get(table):
+                    self._rows[table] = get_table(conn, table, columns=columns)
+                    self._fingerprints[table] = fingerprint
+                    changed.add(table)
+        self.checked = time.monotonic()
+        self.polls += 1
+        self.reloads += len(changed)
+        if changed:
+            self.version += 1
+        return changed
+
+    def _notify(self, changed):
+        if changed:
+            for listener in self._listeners:
+                listener(changed)
+
+    def _stale(self):
+        return self.checked is None or time.monotonic() - self.checked > self.max_age
+
+    def rows(self, table):
+        """ Return all rows of `table`, rows are shared and must not be modified. """
+        if self._stale():
+            changed = set()
+            with self._lock:
+                if self._stale():
+                    changed = self._poll()
+            self._notify(changed)
+        return self._rows[table]
+
+    def get_table(self, table, filters=None, order_by=None, columns=None):
+        """ Same as `db.get_table`, served from memory. """
+        rows = filter_rows(self.rows(table), filters, order_by)
+        if columns:
+            return [{column: row[column] for column in columns} for row in rows]
+        return [dict(row) for row in rows]
+
+    def stats(self):
+        return {'tables': {table: len(rows) for table, rows in self._rows.items()},
+                'version': self.version,
+                'age': time.monotonic() - self.checked if self.checked else None,
+                'polls': self.polls,
+                'reloads': self.reloads}
+
+
+class ChipIndex(object):
+    """
+    Competitors from OEVLISTSVIEW keyed by their chip number column.
+
+    The whole view is loaded once and reloaded in the background when older than `max_age` seconds.
+    Chips that are not in the index are looked up with `load_one`, so chips assigned in OEvent
+    during the race are found immediately and a swapped out chip is stale for at most `max_age`.
+    """
+
+    def __init__(self, load_all, load_one, key, max_age=30):
+        """
+        Args:
+            load_all: callable returning all OEVLISTSVIEW rows
+            load_one: callable returning OEVLISTSVIEW rows for a chip number
+            key: chip number column, CHIPNUMBER<stage>
+            max_age: seconds after which the index is reloaded
+        """
+        self.load_all = load_all
+        self.load_one = load_one
+        self.key = key
+        self.max_age = max_age
+        self.loaded = None
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self, chip_number):
+        """ Return OEVLISTSVIEW rows for `chip_number`, rows are shared and must not be modified. """
+        if self._index is None:
+            self.refresh()
+        elif time.monotonic() - self.loaded > self.max_age:
+            self.refresh_async()
+
+        chip_number = str(chip_number)
+        competitors = self._index.get(chip_number)
+        if competitors is not None:
+            self.hits += 1
+            return competitors
+
+        self.misses += 1
+        competitors = self.load_one(chip_number)
+        self._index[chip_number] = competitors
+        return competitors
+
+    def refresh(self):
+        """ Reload the index from OEVLISTSVIEW. """
+        index = {}
+        for competitor in self.load_all():
+            if competitor[self.key] is not None:
+                index.setdefault(str(competitor[self.key]), []).append(competitor)
+        self._index = index
+        self.loaded = time.monotonic()
+
+    def refresh_async(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._refresh_background, name='chip-index')
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_background(self):
+        try:
+            self.refresh()
+        except Exception as exception:
+            print("Chip index refresh failed: ", exception)
+        finally:
+            self._refreshing = False
+
+    def stats(self):
+        return {'chips': len(self._index or ()),
+                'age': time.monotonic() - self.loaded if self.loaded else None,
+                'hits': self.hits,
+                'misses': self.misses}
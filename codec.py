@@ -0,0 +1,70 @@
+""" Compact encodings of realtime punch events """
+
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FIELDS = ('chipNumber', 'stationCode', 'time', 'seq', 'startNumber')
+PUNCH = struct.Struct('<IHdII')  # little endian, 22 bytes per punch
+ROOM_PREFIX = 'enc:'
+
+
+def encodings():
+    """ Encodings clients can choose, `msgpack` only when the package is installed """
+    return ('json', 'struct') + (('msgpack',) if msgpack is not None else ())
+
+
+def encoding_room(encoding):
+    return ROOM_PREFIX + encoding
+
+
+def room_encoding(room):
+    """ Encoding of an `encoding_room`, None for other rooms """
+    if room is not None and room.startswith(ROOM_PREFIX):
+        return room[len(ROOM_PREFIX):]
+    return None
+
+
+def describe(encoding):
+    """ Layout of `encoding` sent to a client choosing it """
+    description = {'encoding': encoding, 'fields': FIELDS}
+    if encoding == 'struct':
+        description['format'] = PUNCH.format if isinstance(PUNCH.format, str) else PUNCH.format.decode()
+        description['size'] = PUNCH.size
+    return description
+
+
+def punch_values(event):
+    """ Values of FIELDS of a punch event, 0 for unknown runner or seq """
+    runner = event.get('runner') or {}
+    return (int(event['chipNumber']), event['stationCode'], event['time'], event.get('seq', 0),
+            runner.get('startNumber') or 0)
+
+
+def encode_punches(encoding, events):
+    """
+    Args:
+        encoding: 'struct' or 'msgpack'
+        events: punch events
+    Returns:
+        bytes: `struct` records of FIELDS back to back, or a msgpack array of FIELDS arrays
+    """
+    if encoding == 'struct':
+        return b''.join(PUNCH.pack(*punch_values(event)) for event in events)
+    if encoding == 'msgpack' and msgpack is not None:
+        return msgpack.packb([punch_values(event) for event in events])
+    raise ValueError('unknown encoding ' + str(encoding))
+
+
+def decode_punches(encoding, data):
+    """ Dicts of FIELDS from `encode_punches` output """
+    if encoding == 'struct':
+        values = PUNCH.iter_unpack(data)
+    elif encoding == 'msgpack' and msgpack is not None:
+        values = msgpack.unpackb(data)
+    else:
+        raise ValueError('unknown encoding ' + str(encoding))
+    return [dict(zip(FIELDS, punch)) for punch in values]
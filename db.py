@@ -1,9 +1,12 @@
 from timeit import default_timer as timer
 from collections import namedtuple
+from numbers import Number
+
+import datetime
+import time
 
 import firebirdsql
 
-STR_ESCAPE = "'"
 STATUS_CODES = {
     0: 'Active',
     1: 'OK',
@@ -23,6 +26,30 @@ STATUS_CODE_SORT = {
 }
 
 
+COMPETITOR_COLUMNS = ('STARTNUMBER', 'FIRSTNAME', 'LASTNAME', 'CLUBLONGNAME', 'CLUBSHORTNAME', 'COUNTRYSHORTNAME',
+                     'CATEGORYID', 'CATEGORYNAME', 'ISVACANT')
+COMPETITOR_STAGE_COLUMNS = ('CHIPNUMBER', 'STARTTIME', 'FINISHTYPE', 'COMPETITIONTIME', 'ISRUNNING')
+
+OPERATORS = {
+    '=': lambda a, b: a == b,
+    '<>': lambda a, b: a != b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b
+}
+
+
+def competitor_columns(stage):
+    """ OEVLISTSVIEW columns used for `stage`. """
+    return COMPETITOR_COLUMNS + tuple(column + stage for column in COMPETITOR_STAGE_COLUMNS)
+
+
+def competition_columns(stage):
+    """ OEVCOMPETITION columns used for `stage`. """
+    return 'COMPETITIONNAME', 'COMPETITIONPLACE', 'ORGANIZER', 'DATE' + stage, 'FIRSTSTART' + stage
+
+
 def connect_db(dsn, username, password):
     """Connects to the specific database."""
     return firebirdsql.connect(dsn=dsn, user=username, password=password)
@@ -36,25 +63,71 @@ def test_conn(conn):
     return data[0][0]
 
 
-def get_table(conn, table, filters=None, order_by=None):
-    """ Return `table` from `conn` and return it as dictionary. """
+def get_table(conn, table, filters=None, order_by=None, columns=None):
+    """ Return `columns` (all by default) of `table` from `conn` and return it as dictionary. """
+    if hasattr(conn, 'get_table'):  # in-memory cache.Snapshot
+        return conn.get_table(table, filters, order_by, columns)
     start = timer()
+    filters = filters or {}
+    sql = get_query(table, tuple(columns) if columns else None,
+                    tuple((k, get_operator(v)) for k, v in filters.items()), order_by)
+    params = [v[1] if isinstance(v, tuple) else v for v in filters.values()]
     cur = conn.cursor()
-    sql = 'SELECT * FROM %s' % table
-    if filters:
-        sql += ' WHERE ' + ' AND '.join(
-            str(k) + ' ' + get_operator(v) + ' ' + STR_ESCAPE + get_value(v) + STR_ESCAPE for k, v in filters.items())
+    cur.execute(sql, params)
+    data = cur.fetchall()
+    desc = [description[0] for description in cur.description]
+    cur.close()
+    print('{} {:.4f}ms'.format(sql, (timer()-start)*1000))
+    return [{d: e for e, d in zip(row, desc)} for row in data]
+
+
+def get_query(table, columns, conditions, order_by):
+    """ SQL for a `get_table` query, values of `conditions` are bind parameters. """
+    sql = 'SELECT %s FROM %s' % (','.join(columns) if columns else '*', table)
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(str(k) + ' ' + op + ' ?' for k, op in conditions)
     if order_by:
         if isinstance(order_by, tuple):
             sql += ' ORDER BY ' + ','.join(order_by)
         else:
             sql += ' ORDER BY ' + order_by
-    cur.execute(sql)
+    return sql
+
+
+def filter_rows(rows, filters=None, order_by=None):
+    """ Apply `get_table` filters and ordering to rows already in memory. """
+    if filters:
+        conditions = [(k, OPERATORS[get_operator(v)], get_value(v)) for k, v in filters.items()]
+        rows = [row for row in rows if all(compare(row[k], op, value) for k, op, value in conditions)]
+    if order_by:
+        columns = order_by if isinstance(order_by, tuple) else (order_by,)
+        # Firebird sorts NULLs first in ascending order
+        rows = sorted(rows, key=lambda row: tuple((row[c] is not None, row[c]) for c in columns))
+    return rows
+
+
+def compare(column, op, value):
+    """ Compare `column` value to filter `value` given as string, as Firebird would. """
+    if column is None:
+        return False
+    if isinstance(column, Number):
+        try:
+            column, value = float(column), float(value)
+        except ValueError:
+            return False
+    else:
+        column = str(column)
+    return op(column, value)
+
+
+def get_fingerprint(conn, table, columns):
+    """ Return row count and checksum of `columns` in `table`, changes when any of the values change. """
+    cur = conn.cursor()
+    row = ' || \'|\' || '.join("COALESCE(CAST(%s AS VARCHAR(255)), '')" % c for c in columns)
+    cur.execute('SELECT COUNT(*), SUM(MOD(HASH(%s), 1000000007)) FROM %s' % (row, table))
     data = cur.fetchall()
-    desc = [description[0] for description in cur.description]
     cur.close()
-    print('{} {:.4f}ms'.format(sql, (timer()-start)*1000))
-    return [{d: e for e, d in zip(row, desc)} for row in data]
+    return tuple(data[0])
 
 
 def get_value(v):
@@ -70,39 +143,42 @@ def get_operator(v):
 
 
 def get_categories(conn):
-    table = get_table(conn, 'OEVCATEGORY')
+    table = get_table(conn, 'OEVCATEGORY', columns=('CATEGORYNAME',))
     return [row['CATEGORYNAME'] for row in table]
 
 
 def get_category_runners(conn, category_id, stage):
-    table = get_table(conn, 'OEVLISTSVIEW', {'CATEGORYNAME': category_id, 'ISRUNNING' + stage: 1})
+    table = get_table(conn, 'OEVLISTSVIEW', {'CATEGORYNAME': category_id, 'ISRUNNING' + stage: 1},
+                      columns=competitor_columns(stage))
     return [to_runner_data(row, stage) for row in table]
 
 
 def get_category_startlist(conn, category_id, stage):
-    table = get_table(conn, 'OEVLISTSVIEW', {'CATEGORYNAME': category_id, 'ISRUNNING' + stage: 1}, 'STARTTIME' + stage)
+    table = get_table(conn, 'OEVLISTSVIEW', {'CATEGORYNAME': category_id, 'ISRUNNING' + stage: 1}, 'STARTTIME' + stage,
+                      competitor_columns(stage))
     return [to_runner_data(row, stage) for row in table]
 
 
 def get_category_official_results(conn, category_id, stage):
     table = get_table(conn, 'OEVLISTSVIEW',
                       {'CATEGORYNAME': category_id, 'ISRUNNING' + stage: 1, 'FINISHTYPE' + stage: ('>', 0)},
-                      ('FINISHTYPE' + stage, 'COMPETITIONTIME' + stage))
+                      ('FINISHTYPE' + stage, 'COMPETITIONTIME' + stage), competitor_columns(stage))
     return [to_runner_data(row, stage) for row in table]
 
 
 def get_runner_by_start_number(conn, start_number,stage):
-    table = get_table(conn, 'OEVLISTSVIEW', {'STARTNUMBER': start_number, 'ISRUNNING' + stage: 1})
+    table = get_table(conn, 'OEVLISTSVIEW', {'STARTNUMBER': start_number, 'ISRUNNING' + stage: 1},
+                      columns=competitor_columns(stage))
     return [to_runner_data(row, stage) for row in table]
 
 
 def get_runner_by_chip_number(conn, chip_number, stage):
-    table = get_table(conn, 'OEVLISTSVIEW', {'CHIPNUMBER' + stage: chip_number})
+    table = get_table(conn, 'OEVLISTSVIEW', {'CHIPNUMBER' + stage: chip_number}, columns=competitor_columns(stage))
     return [to_runner_data(row, stage) for row in table]
 
 
 def get_competitor_by_chip_number(conn, chip_number, stage):
-    return get_table(conn, 'OEVLISTSVIEW', {'CHIPNUMBER' + stage: chip_number})
+    return get_table(conn, 'OEVLISTSVIEW', {'CHIPNUMBER' + stage: chip_number}, columns=competitor_columns(stage))
 
 
 def to_runner_data(table_row, stage):
@@ -121,7 +197,7 @@ def to_runner_data(table_row, stage):
 
 
 def get_competition_data(conn, stage):
-    table = get_table(conn, 'OEVCOMPETITION')[0]
+    table = get_table(conn, 'OEVCOMPETITION', columns=competition_columns(stage))[0]
     d = {'name': table['COMPETITIONNAME'],
          'place': table['COMPETITIONPLACE'],
          'organizer': table['ORGANIZER'],
@@ -130,6 +206,40 @@ def get_competition_data(conn, stage):
     return d
 
 
+def get_punches(conn, stage, chip_numbers=None, chunk_size=500):
+    """ Return punches for `chip_numbers`, or for the whole `stage`, grouped by chip number as string. """
+    if chip_numbers is None:
+        data = query_db(conn, 'SELECT * FROM punches WHERE stage = ?', (stage,))
+    else:
+        chip_numbers = list(chip_numbers)
+        data = []
+        for i in range(0, len(chip_numbers), chunk_size):
+            chunk = chip_numbers[i:i + chunk_size]
+            data += query_db(conn, 'SELECT * FROM punches WHERE stage = ? AND chipNumber IN (%s)' % ','.join('?' * len(chunk)),
+                             [stage] + chunk)
+    punches = {}
+    for d in data:
+        punches.setdefault(str(d[0]), []).append(d)
+    return punches
+
+
+CompetitionContext = namedtuple('CompetitionContext', ['first_start', 'day', 'midnight'])
+
+
+def get_competition_context(conn, stage):
+    """ Stage data needed to convert punch times, `midnight` is unix time of midnight starting `day`, today. """
+    competition = get_competition_data(conn, stage)
+    day = datetime.date.today()
+    midnight = time.mktime(datetime.datetime.combine(day, datetime.time.min).timetuple())
+    return CompetitionContext(competition['firstStart'], day, midnight)
+
+
+def get_finish_punches_fingerprint(conn, stage):
+    """ Return count and checksum of finish punches, changes when a finish punch is added or replaced. """
+    return tuple(query_db(conn, 'SELECT COUNT(*), TOTAL(chipNumber * 86400 + time) FROM punches '
+                                'WHERE stationCode = 0 AND stage = ?', (stage,), one=True))
+
+
 def query_db(conn, query, args=(), one=False):
     cur = conn.execute(query, args)
     rv = cur.fetchall()
@@ -0,0 +1,178 @@
+""" Append-only feed of exported punches """
+
+import json
+import os
+import threading
+import time
+
+from files import write_file
+
+INDEX = 'index.json'
+
+
+class Feed(object):
+    """
+    Sequence numbered records appended to newline delimited JSON segment files in `folder`.
+
+    `index.json` lists segments in order with the first and last sequence number they contain,
+    the last segment is the one being appended to and has `last` set to null. Consumers read the index
+    and every segment whose `last` is above their offset, skipping records up to the offset and an
+    incomplete last line.
+
+    The current segment is closed when it grows over `segment_bytes` or gets older than `segment_seconds`.
+    Closed segments older than `compact_after` seconds are merged into one compacted segment that keeps
+    only the newest record of each chip and station, so the number of files stays bounded over a day.
+    """
+
+    def __init__(self, folder, segment_bytes=1048576, segment_seconds=300, compact_after=3600, key=None):
+        """
+        Args:
+            folder: directory with the index and segments
+            segment_bytes: size at which a segment is closed
+            segment_seconds: age in seconds at which a segment is closed
+            compact_after: seconds after which closed segments are compacted
+            key: callable returning the key of a record, of records with the same key only the newest
+                is kept by compaction
+        """
+        self.folder = folder
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.compact_after = compact_after
+        self.key = key or (lambda record: (record['chipNumber'], record['stationCode']))
+        self.appended = 0
+        self.rotations = 0
+        self.compactions = 0
+        self._lock = threading.Lock()
+        self._file = None
+        os.makedirs(folder, exist_ok=True)
+        self._segments = self._load_index()
+        self.seq = self._last_seq()
+
+    def _load_index(self):
+        path = os.path.join(self.folder, INDEX)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return json.load(f)['segments']
+
+    def _last_seq(self):
+        """ Last sequence number, the open segment of a previous run is closed at its last record """
+        if not self._segments:
+            return 0
+        segment = self._segments[-1]
+        if segment['last'] is None:
+            records = self._read_segment(segment)
+            segment['last'] = records[-1]['seq'] if records else segment['first'] - 1
+        return max(segment['last'] for segment in self._segments)
+
+    def _write_index(self):
+        data = json.dumps({'segments': self._segments}, indent=1).encode('utf-8')
+        write_file(os.path.join(self.folder, INDEX), data)
+
+    def append(self, records):
+        """
+        Append `records`, dicts serialisable to JSON, each gets the next `seq`.
+
+        Returns:
+            int: sequence number of the last appended record
+        """
+        with self._lock:
+            if self._file is None or self._should_rotate():
+                self._rotate()
+            lines = []
+            for record in records:
+                self.seq += 1
+                lines.append(json.dumps(dict(record, seq=self.seq), separators=(',', ':')))
+            self._file.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+            self._file.flush()
+            self.appended += len(lines)
+            return self.seq
+
+    def _should_rotate(self):
+        segment = self._segments[-1]
+        return self._file.tell() >= self.segment_bytes or time.time() - segment['created'] >= self.segment_seconds
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+            self.rotations += 1
+        if self._segments and self._segments[-1]['last'] is None:
+            self._segments[-1]['last'] = self.seq
+        first = self.seq + 1
+        name = 'segment-{:012d}.ndjson'.format(first)
+        self._segments.append({'file': name, 'first': first, 'last': None, 'created': time.time()})
+        self._file = open(os.path.join(self.folder, name), 'ab')
+        merged = self._compact()
+        self._write_index()
+        for merged_file in merged:
+            os.remove(os.path.join(self.folder, merged_file))
+
+    def _compact(self):
+        """
+        Merge closed segments older than `compact_after`, they are at the start of the index.
+
+        Returns:
+            list: files of merged segments, to be removed once the index is written
+        """
+        old = []
+        for segment in self._segments[:-1]:
+            if segment['created'] > time.time() - self.compact_after:
+                break
+            old.append(segment)
+        if not old or (len(old) == 1 and old[0].get('compacted')):
+            return []
+
+        newest = {}
+        for segment in old:
+            for record in self._read_segment(segment):
+                newest[self.key(record)] = record
+        records = sorted(newest.values(), key=lambda record: record['seq'])
+        last = old[-1]['last']
+        name = 'compacted-{:012d}.ndjson'.format(last)
+        data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        write_file(os.path.join(self.folder, name), data.encode('utf-8'))
+        self._segments[:len(old)] = [{'file': name, 'first': old[0]['first'], 'last': last,
+                                      'created': old[-1]['created'], 'compacted': True}]
+        self.compactions += 1
+        return [segment['file'] for segment in old]
+
+    def _read_segment(self, segment):
+        records = []
+        try:
+            with open(os.path.join(self.folder, segment['file']), 'rb') as f:
+                for line in f:
+                    if line.endswith(b'\n'):
+                        records.append(json.loads(line.decode('utf-8')))
+        except FileNotFoundError:
+            pass
+        return records
+
+    def read(self, since=0, limit=1000):
+        """
+        Returns:
+            list: up to `limit` records with `seq` above `since`
+        """
+        records = []
+        with self._lock:  # compaction removes segment files
+            for segment in self._segments:
+                if segment['last'] is not None and segment['last'] <= since:
+                    continue
+                for record in self._read_segment(segment):
+                    if record['seq'] > since:
+                        records.append(record)
+                        if len(records) >= limit:
+                            return records
+        return records
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self):
+        return {'seq': self.seq,
+                'segments': len(self._segments),
+                'appended': self.appended,
+                'rotations': self.rotations,
+                'compactions': self.compactions}
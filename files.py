@@ -0,0 +1,129 @@
+""" Atomic writes of exported files """
+
+import gzip
+import hashlib
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+hashes = {}  # path -> sha1 of the content last written to it
+written = 0
+unchanged = 0
+
+
+class HashingFile(object):
+    """ Binary file object passing writes to a temporary file and its gzip copy while hashing the content """
+
+    def __init__(self, f, compressed=None, volatile=None):
+        self.f = f
+        self.compressed = compressed
+        self.volatile = volatile
+        self.hash = hashlib.sha1()
+        self.changed = None
+
+    def write(self, data):
+        self.hash.update(self.volatile.sub(b'', data) if self.volatile else data)
+        if self.compressed is not None:
+            self.compressed.write(data)
+        return self.f.write(data)
+
+
+@contextmanager
+def atomic_file(path, compress=False, volatile=None):
+    """
+    Yields a binary file object whose content replaces `path` when the block exits without an exception.
+
+    Content is written to a temporary file in the same folder and renamed over `path`, so readers see either
+    the old or the new file. When the content hash matches what is already in `path`, the temporary file is
+    dropped and `path` keeps its mtime. After the block `changed` attribute of the yielded object tells
+    whether `path` was replaced.
+
+    Args:
+        path: file to write
+        compress: also write a gzip copy to `path`.gz
+        volatile: compiled bytes regex of content left out of the hash, e.g. a creation time,
+            each match has to be written with a single `write` call
+    """
+    global written, unchanged
+    folder = os.path.dirname(path) or '.'
+    temp = tempfile.NamedTemporaryFile(dir=folder, suffix='.tmp', delete=False)
+    temp_gz = None
+    try:
+        compressed = None
+        if compress:
+            temp_gz = tempfile.NamedTemporaryFile(dir=folder, suffix='.gz.tmp', delete=False)
+            compressed = gzip.GzipFile(os.path.basename(path), 'wb', fileobj=temp_gz, mtime=0)
+        out = HashingFile(temp, compressed, volatile)
+        yield out
+        temp.close()
+        if compressed is not None:
+            compressed.close()
+            temp_gz.close()
+
+        digest = out.hash.digest()
+        out.changed = current_hash(path, volatile) != digest
+        if out.changed:
+            replace(temp.name, path)
+            hashes[path] = digest
+            written += 1
+        else:
+            unchanged += 1
+        if temp_gz is not None and (out.changed or not os.path.exists(path + '.gz')):
+            replace(temp_gz.name, path + '.gz')
+    finally:
+        for f in (temp, temp_gz):
+            if f is not None:
+                f.close()
+                if os.path.exists(f.name):
+                    os.remove(f.name)
+
+
+def write_file(path, data, compress=False, volatile=None):
+    """
+    Atomically replace `path` with `data` unless it already has the same content, `data` is hashed
+    before anything is written.
+
+    Returns:
+        bool: True when the file was written
+    """
+    global unchanged
+    digest = hashlib.sha1(volatile.sub(b'', data) if volatile else data).digest()
+    if current_hash(path, volatile) == digest and (not compress or os.path.exists(path + '.gz')):
+        unchanged += 1
+        return False
+    with atomic_file(path, compress, volatile) as f:
+        f.write(data)
+    return f.changed
+
+
+def current_hash(path, volatile=None):
+    """ Hash of the content of `path`, None when it does not exist, e.g. a consumer removed it """
+    if not os.path.exists(path):
+        hashes.pop(path, None)
+        return None
+    if path not in hashes:
+        hashes[path] = file_hash(path, volatile)
+    return hashes[path]
+
+
+def file_hash(path, volatile=None):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return hashlib.sha1(volatile.sub(b'', data) if volatile else data).digest()
+
+
+def replace(source, destination, retries=10):
+    # on Windows a file can not be replaced while another program has it open, the reader is done soon
+    for attempt in range(retries):
+        try:
+            os.replace(source, destination)
+            return
+        except PermissionError:
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.05)
+
+
+def stats():
+    return {'written': written, 'unchanged': unchanged}
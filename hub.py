@@ -0,0 +1,174 @@
+""" Fan-out and replay of live events """
+
+import json
+import queue
+import threading
+import uuid
+from collections import deque
+from itertools import islice
+
+
+class PunchLog(object):
+    """
+    Last `size` ingested punch events, numbered with increasing `seq`.
+
+    Reconnecting clients ask for events since the last seq they have and get a slice of the buffer.
+    `instance` changes when the server restarts and numbering starts again, clients pass the instance
+    their seq belongs to.
+    """
+
+    def __init__(self, size=10000):
+        self.instance = uuid.uuid4().hex
+        self.seq = 0
+        self._events = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def append(self, event):
+        """ Set `seq` of `event` and keep it. """
+        with self._lock:
+            self.seq += 1
+            event['seq'] = self.seq
+            self._events.append(event)
+
+    def since(self, seq, limit=None, instance=None):
+        """
+        Args:
+            seq: last seq the client has
+            limit: maximal number of returned events
+            instance: `instance` of the server that numbered `seq`
+        Returns:
+            dict: `punches` after `seq`, current `seq`, `instance` and `complete`, False when punches after
+                `seq` were dropped from the buffer or `seq` is from before a restart, the client should reload
+        """
+        with self._lock:
+            restarted = instance is not None and instance != self.instance
+            if restarted:
+                seq = 0
+            first = self._events[0]['seq'] if self._events else self.seq + 1
+            complete = first - 1 <= seq <= self.seq and not restarted
+            start = max(seq - first + 1, 0) if seq <= self.seq else 0
+            end = None if limit is None else start + limit
+            punches = list(islice(self._events, start, end))
+            return {'punches': punches, 'seq': self.seq, 'instance': self.instance, 'complete': complete}
+
+
+class Subscriber(object):
+    """ Bounded buffer of events for one SSE connection """
+
+    def __init__(self, topics, buffer_size):
+        """
+        Args:
+            topics: set of topics to receive, None for all
+            buffer_size: events buffered before the subscriber is evicted
+        """
+        self.topics = topics
+        self.queue = queue.Queue(buffer_size)
+        self.evicted = False
+
+    def wants(self, topic):
+        return self.topics is None or topic in self.topics
+
+
+class Hub(object):
+    """
+    Publishes events to subscribers of their topic, each event is serialised once for all subscribers.
+
+    Every event gets the next id, the last `history` events are kept for subscribers resuming with
+    `Last-Event-ID`. A subscriber whose buffer is full is evicted, its stream ends and the client reconnects
+    and resumes from history. When events it missed are not in history any more it gets a `resync` event
+    and should reload results over HTTP.
+    """
+
+    def __init__(self, buffer_size=256, history=1000):
+        self.buffer_size = buffer_size
+        self.seq = 0
+        self.published = 0
+        self.evicted = 0
+        self.resyncs = 0
+        self._history = deque(maxlen=history)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, event, topic, data):
+        """
+        Args:
+            event: SSE event name
+            topic: e.g. category name, None for events only subscribers of all topics receive
+            data: payload serialisable to JSON
+        """
+        message = json.dumps(data, separators=(',', ':'))
+        with self._lock:
+            self.seq += 1
+            item = (self.seq, event, topic, message)
+            self._history.append(item)
+            subscribers = list(self._subscribers)
+            self.published += 1
+        for subscriber in subscribers:
+            if subscriber.wants(topic):
+                try:
+                    subscriber.queue.put_nowait(item)
+                except queue.Full:
+                    self._evict(subscriber)
+
+    def subscribe(self, topics=None, last_event_id=None):
+        """
+        Args:
+            topics: topics to receive, all when empty
+            last_event_id: id of the last event the client received before reconnecting
+        Returns:
+            Subscriber
+        """
+        subscriber = Subscriber(set(topics) if topics else None, self.buffer_size)
+        with self._lock:
+            if last_event_id is not None:
+                self._replay(subscriber, last_event_id)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def _replay(self, subscriber, last_event_id):
+        first = self._history[0][0] if self._history else self.seq + 1
+        if last_event_id > self.seq or last_event_id < first - 1:
+            self._resync(subscriber)
+            return
+        missed = [item for item in self._history if item[0] > last_event_id and subscriber.wants(item[2])]
+        if len(missed) >= self.buffer_size:
+            self._resync(subscriber)
+            return
+        for item in missed:
+            subscriber.queue.put_nowait(item)
+
+    def _resync(self, subscriber):
+        self.resyncs += 1
+        subscriber.queue.put_nowait((self.seq, 'resync', None, '{}'))
+
+    def _evict(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.discard(subscriber)
+                subscriber.evicted = True
+                self.evicted += 1
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stream(self, subscriber, keepalive=15):
+        """ Yields `subscriber` events in SSE format until it is evicted or the generator is closed. """
+        try:
+            yield b'retry: 2000\n\n'
+            while not subscriber.evicted:
+                try:
+                    seq, event, _, message = subscriber.queue.get(timeout=keepalive)
+                except queue.Empty:
+                    yield b': keepalive\n\n'
+                    continue
+                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(seq, event, message).encode('utf-8')
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self):
+        return {'subscribers': len(self._subscribers),
+                'seq': self.seq,
+                'published': self.published,
+                'evicted': self.evicted,
+                'resyncs': self.resyncs}
@@ -0,0 +1,165 @@
+""" Reduced IOF v3 PyXB bindings for the XML export
+
+The full `iof.py` binds every type of the IOF Data Standard 3.0. This script reduces IOF.xsd to the
+types used by `oevent2xml` and generates bindings for it with pyxbgen:
+
+    python iofgen.py IOF.xsd --module iof_export
+
+Optional elements with a type outside of the kept set (courses, fees, services, extensions, ...) are removed,
+types of required elements, base types and attributes are kept. The reduced schema is saved next to the module
+as `<module>.xsd`. Select the bindings with `IOF_BINDINGS='iof_export'` and compare them with
+`flask bench_bindings --module iof --module iof_export`.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import xml.etree.ElementTree as ET
+
+import click
+
+XS = 'http://www.w3.org/2001/XMLSchema'
+IOF_NAMESPACE = 'http://www.orienteering.org/datastandard/3.0'
+
+ROOT_ELEMENTS = ('ResultList',)
+EXPORT_TYPES = ('ClassResult', 'PersonResult', 'PersonRaceResult', 'SplitTime', 'Event', 'Organisation', 'Person',
+                'PersonName', 'DateAndOptionalTime', 'ResultStatus')
+
+DEFINITIONS = ('complexType', 'simpleType', 'element', 'group', 'attributeGroup', 'attribute')
+TYPE_ATTRIBUTES = ('type', 'base', 'ref', 'itemType')
+
+
+def xs(tag):
+    return '{%s}%s' % (XS, tag)
+
+
+def local_name(qname):
+    """ Name of a type in the IOF namespace, None for built-in xs: types """
+    if qname is None or (':' in qname and not qname.startswith('iof:')):
+        return None
+    return qname.split(':')[-1]
+
+
+def references(node):
+    """ Names of IOF definitions referenced by `node` and its descendants """
+    names = set()
+    for child in node.iter():
+        for attribute in TYPE_ATTRIBUTES:
+            name = local_name(child.get(attribute))
+            if name:
+                names.add(name)
+        for member in child.get('memberTypes', '').split():
+            if local_name(member):
+                names.add(local_name(member))
+    return names
+
+
+def is_optional(node, parents):
+    """ Element can be left out of a valid document, alone or with an enclosing sequence or choice """
+    if node.get('minOccurs') == '0':
+        return True
+    parent = parents.get(node)
+    while parent is not None and parent.tag in (xs('sequence'), xs('choice'), xs('all')):
+        if parent.get('minOccurs') == '0' or parent.tag == xs('choice'):
+            return True
+        parent = parents.get(parent)
+    return False
+
+
+def reduce_schema(schema, roots=ROOT_ELEMENTS, types=EXPORT_TYPES):
+    """
+    Remove definitions from `schema` that are not needed for documents with `roots` elements built from `types`.
+
+    Args:
+        schema: parsed IOF.xsd root element, modified in place
+        roots: top level elements to keep
+        types: types whose optional elements are kept
+    Returns:
+        set: names of kept definitions
+    """
+    definitions = {child.get('name'): child for child in schema
+                   if child.tag.split('}')[-1] in DEFINITIONS and child.get('name')}
+    keep = set(roots) | set(types)
+    parents = {child: parent for parent in schema.iter() for child in parent}
+
+    done = set()
+    while keep - done:
+        name = (keep - done).pop()
+        done.add(name)
+        definition = definitions.get(name)
+        if definition is None:
+            continue
+        for element in list(definition.iter(xs('element'))):
+            if element is definition:
+                continue
+            needed = references(element)
+            if is_optional(element, parents) and not needed <= keep:
+                parent = parents[element]
+                if parent.tag == xs('choice') and len(parent) == 1:
+                    keep |= needed  # last alternative of a choice stays, and the types it references
+                    continue
+                parent.remove(element)
+                continue
+            keep |= needed
+        for node in definition.iter():
+            if node.tag != xs('element'):
+                for attribute in ('base', 'ref', 'itemType'):
+                    if local_name(node.get(attribute)):
+                        keep.add(local_name(node.get(attribute)))
+            if node.tag == xs('attribute'):
+                keep |= references(node)
+
+    for child in list(schema):
+        if child.tag == xs('annotation') or (child.get('name') and child.get('name') not in keep):
+            schema.remove(child)
+    for parent in list(schema.iter()):
+        for child in list(parent):
+            if child.tag == xs('annotation'):
+                parent.remove(child)
+    return keep & set(definitions)
+
+
+def dangling(schema):
+    """ Names of IOF definitions referenced in `schema` but not defined in it """
+    defined = {child.get('name') for child in schema if child.get('name')}
+    return references(schema) - defined
+
+
+def parse_schema(path):
+    """ Parse `path` and register its prefix of the XML Schema namespace, type names like `xsd:string` keep it. """
+    for _, (prefix, uri) in ET.iterparse(path, events=('start-ns',)):
+        if uri == XS:
+            ET.register_namespace(prefix, XS)
+    return ET.parse(path).getroot()
+
+
+def write_schema(schema, path):
+    schema.set('xmlns', IOF_NAMESPACE)
+    ET.ElementTree(schema).write(path, encoding='utf-8', xml_declaration=True)
+
+
+@click.command()
+@click.argument('xsd', type=click.Path(exists=True))
+@click.option('--module', default='iof_export', help='Name of the generated bindings module')
+@click.option('--pyxbgen', default=None, help='pyxbgen executable, by default found on PATH or next to python')
+def main(xsd, module, pyxbgen):
+    schema = parse_schema(xsd)
+    kept = reduce_schema(schema)
+    click.echo('Kept {} definitions: {}'.format(len(kept), ', '.join(sorted(kept))))
+    missing = dangling(schema)
+    if missing:
+        raise click.ClickException('Reduced schema references removed definitions: ' + ', '.join(sorted(missing)))
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    reduced = os.path.join(directory, module + '.xsd')
+    write_schema(schema, reduced)
+    click.echo('Saved to: {}'.format(reduced))
+
+    pyxbgen = pyxbgen or shutil.which('pyxbgen') or os.path.join(os.path.dirname(sys.executable), 'pyxbgen')
+    subprocess.run([sys.executable, pyxbgen, '-u', reduced, '-m', module], cwd=directory, check=True)
+    click.echo('Generated: {}'.format(os.path.join(directory, module + '.py')))
+
+
+if __name__ == '__main__':
+    main()
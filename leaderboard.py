@@ -0,0 +1,129 @@
+""" Live results kept in memory and updated on every punch """
+
+import threading
+from bisect import bisect_left
+
+from db import STATUS_CODE_SORT
+
+
+class Leaderboard(object):
+    """
+    Runners of one category that punched one station, in result order.
+
+    Entries are runner data dicts with `competitionTime` of the punch. Each entry carries precomputed
+    `rank` (None for runners with a final non OK status), `timeBehind` the leader and `previousRank`.
+    """
+
+    def __init__(self, entries=()):
+        self._keys = []
+        self._entries = {}
+        self._leader = None
+        for entry in entries:
+            key = self._key(entry)
+            self._keys.insert(bisect_left(self._keys, key), key)
+            self._entries[key[-1]] = entry
+        self._rank(0)
+
+    @staticmethod
+    def _key(entry):
+        return STATUS_CODE_SORT[entry['finishType']], entry['competitionTime'], str(entry['startNumber'])
+
+    def update(self, entry):
+        """
+        Insert `entry` or move the runner's existing entry.
+
+        Returns:
+            list: entries whose rank or time behind changed, including `entry`
+        """
+        runner = str(entry['startNumber'])
+        start = len(self._keys)
+        old = self._entries.get(runner)
+        if old is not None:
+            entry['rank'] = old.get('rank')
+            entry['timeBehind'] = old.get('timeBehind')
+            entry['previousRank'] = old.get('previousRank')
+            i = bisect_left(self._keys, self._key(old))
+            del self._keys[i]
+            start = i
+        key = self._key(entry)
+        i = bisect_left(self._keys, key)
+        self._keys.insert(i, key)
+        self._entries[runner] = entry
+        changed = self._rank(min(start, i))
+        if not any(e is entry for e in changed):
+            changed.insert(0, entry)
+        return changed
+
+    def _rank(self, start):
+        leader = self._entries[self._keys[0][-1]] if self._keys else None
+        leader_time = leader['competitionTime'] if leader and self._key(leader)[0] == 0 else None
+        if leader_time != self._leader:
+            self._leader = leader_time
+            start = 0
+
+        changed = []
+        previous = self._entries[self._keys[start - 1][-1]] if start else None
+        for i in range(start, len(self._keys)):
+            entry = self._entries[self._keys[i][-1]]
+            if self._keys[i][0] != 0:
+                rank, behind = None, None
+            else:
+                if previous is not None and previous['competitionTime'] == entry['competitionTime']:
+                    rank = previous['rank']
+                else:
+                    rank = i + 1
+                behind = entry['competitionTime'] - leader_time
+            if 'rank' not in entry or rank != entry['rank'] or behind != entry['timeBehind']:
+                entry['previousRank'] = entry.get('rank')
+                entry['rank'] = rank
+                entry['timeBehind'] = behind
+                changed.append(entry)
+            previous = entry
+        return changed
+
+    def results(self):
+        return [self._entries[key[-1]] for key in self._keys]
+
+
+class LiveResults(object):
+    """ Leaderboards per (category, station), loaded with `load` on first use and then updated by punches. """
+
+    DELTA_FIELDS = ('startNumber', 'rank', 'previousRank', 'timeBehind')
+
+    def __init__(self, load):
+        """
+        Args:
+            load: callable(category, station) returning leaderboard entries from the databases
+        """
+        self.load = load
+        self._boards = {}
+        self._lock = threading.Lock()
+
+    def board(self, category, station):
+        board = self._boards.get((category, station))
+        if board is None:
+            with self._lock:
+                board = self._boards.get((category, station))
+                if board is None:
+                    board = self._boards[(category, station)] = Leaderboard(self.load(category, station))
+        return board
+
+    def results(self, category, station):
+        return self.board(category, station).results()
+
+    def update(self, category, station, entry):
+        """ Apply a punch to the leaderboard, returns changed entries. """
+        return self.board(category, station).update(entry)
+
+    def delta(self, category, station, entry, changed):
+        """ Compact description of `changed` entries, full data is sent only for the punching runner. """
+        return {'category': category,
+                'station': station,
+                'changes': [e if e is entry else {k: e[k] for k in self.DELTA_FIELDS} for e in changed]}
+
+    def clear(self):
+        """ Drop all leaderboards, they are reloaded on next use. """
+        self._boards = {}
+
+    def stats(self):
+        return {'boards': len(self._boards)}
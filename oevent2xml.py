@@ -1,61 +1,107 @@
 """ OEVENT 2 XML """
 
+import importlib
+import re
 from collections import defaultdict
 from datetime import datetime, timedelta
+from io import BytesIO
+from timeit import default_timer as timer
+from xml.sax.saxutils import escape
 
-import pyxb.utils.domutils
+from db import get_table, get_competitor_by_chip_number, query_db, competition_columns, competitor_columns
 
-from db import get_table, get_competitor_by_chip_number, query_db
-from iof import ResultStatus, ResultList, PersonResult, Person, PersonName, Namespace, \
-    PersonRaceResult, Organisation, ClassResult, Class, STD_ANON, DateAndOptionalTime, Event, SplitTime
+IOF_NAMESPACE = 'http://www.orienteering.org/datastandard/3.0'
 
-pyxb.utils.domutils.BindingDOMSupport.SetDefaultNamespace(Namespace)
-
-STATUS_CODES = {
-    0: ResultStatus.Active,
-    1: ResultStatus.OK,
-    2: ResultStatus.Disqualified,
-    3: ResultStatus.DidNotFinish,
-    4: ResultStatus.DidNotStart,
-    5: ResultStatus.MissingPunch
+STATUS_NAMES = {
+    0: 'Active',
+    1: 'OK',
+    2: 'Disqualified',
+    3: 'DidNotFinish',
+    4: 'DidNotStart',
+    5: 'MissingPunch'
 }
 
+CREATOR = "OEVENT2XML v0.1"
+CREATE_TIME = re.compile(b' createTime="[^"]*"')  # differs between exports of the same results
+UTC_OFFSET = timedelta(hours=2)  # OEvent times are local, "+02:00"
 
-def to_person_result(competitor, start_time, stage):
+BINDINGS = 'iof'  # module with IOF v3 PyXB bindings, full `iof` or reduced by iofgen.py
+
+iof = None
+
+
+def bindings():
+    """
+    PyXB bindings are imported on first use, `iof` module registers thousands of classes
+    and is not needed by the streaming writer.
+
+    Returns:
+        module: `BINDINGS` module
+    """
+    global iof
+    if iof is None:
+        import pyxb.utils.domutils
+        module = importlib.import_module(BINDINGS)
+        pyxb.utils.domutils.BindingDOMSupport.SetDefaultNamespace(module.Namespace)
+        iof = module
+    return iof
+
+
+def race_result(competitor, start_time, stage):
     """
     Args:
         competitor: competitor data from OEVENT db
         start_time: competition start time
         stage: competition stage
     Returns:
-        iof.PersonResult
+        tuple: start, running time in seconds or None, status code, (control code, split time in seconds) or None
     """
     start = start_time + timedelta(seconds=competitor['STARTTIME' + stage] / 100)
-
-    x_result = PersonResult()
-    x_result.Person = Person.Factory(Name=PersonName.Factory(
-        Given=competitor['FIRSTNAME'], Family=competitor['LASTNAME']))
-    if competitor['CLUBLONGNAME']:
-        x_result.Organisation = Organisation.Factory(
-            Name=competitor['CLUBLONGNAME'], ShortName=competitor['CLUBSHORTNAME'])
-
-    x_person_result = PersonRaceResult()
-    x_person_result.Status = STATUS_CODES[competitor['FINISHTYPE' + stage]]
-    x_person_result.StartTime = start.isoformat() + "+02:00"
+    status = competitor['FINISHTYPE' + stage]
+    running_time = None
+    split = None
     if competitor['COMPETITIONTIME' + stage]:
-        x_person_result.Time = competitor['COMPETITIONTIME' + stage] / 100
+        running_time = competitor['COMPETITIONTIME' + stage] / 100
 
     if 'SPLITTIME' in competitor:
         station_code, punch_time = competitor['SPLITTIME']
         punch = datetime.fromtimestamp(punch_time)
-        running_time = punch - start
+        split_time = (punch - start).total_seconds()
         if station_code <= 10:
             if not competitor['COMPETITIONTIME' + stage] and not competitor['FINISHTYPE' + stage]:
-                x_person_result.Time = running_time.total_seconds()
-                x_person_result.Status = ResultStatus.OK
+                running_time = split_time
+                status = 1
         else:
-            split = SplitTime.Factory(ControlCode=str(station_code), Time=running_time.total_seconds())
-            x_person_result.SplitTime.append(split)
+            split = (str(station_code), split_time)
+    return start, running_time, status, split
+
+
+def to_person_result(competitor, start_time, stage):
+    """
+    Args:
+        competitor: competitor data from OEVENT db
+        start_time: competition start time
+        stage: competition stage
+    Returns:
+        iof.PersonResult
+    """
+    iof = bindings()
+    x_result = iof.PersonResult()
+    x_result.Person = iof.Person.Factory(Name=iof.PersonName.Factory(
+        Given=competitor['FIRSTNAME'], Family=competitor['LASTNAME']))
+    if competitor['CLUBLONGNAME']:
+        x_result.Organisation = iof.Organisation.Factory(
+            Name=competitor['CLUBLONGNAME'], ShortName=competitor['CLUBSHORTNAME'])
+
+    start, running_time, status, split = race_result(competitor, start_time, stage)
+
+    x_person_result = iof.PersonRaceResult()
+    x_person_result.Status = STATUS_NAMES[status]
+    x_person_result.StartTime = start.isoformat() + "+02:00"
+    if running_time is not None:
+        x_person_result.Time = running_time
+    if split is not None:
+        x_person_result.SplitTime.append(iof.SplitTime.Factory(ControlCode=split[0], Time=split[1]))
 
     x_result.Result.append(x_person_result)
     return x_result
@@ -70,8 +116,9 @@ def to_class_result(category, start_time, stage):
     Returns:
         iof.ClassResult
     """
-    x_class_result = ClassResult()
-    x_class_result.Class = Class.Factory(
+    iof = bindings()
+    x_class_result = iof.ClassResult()
+    x_class_result.Class = iof.Class.Factory(
         Name=category[0]['CATEGORYNAME'], ShortName=category[0]['CATEGORYNAME'])
 
     for competitor in category:
@@ -79,6 +126,10 @@ def to_class_result(category, start_time, stage):
     return x_class_result
 
 
+def competition_start(competition, stage):
+    return competition['DATE' + stage] + timedelta(seconds=competition['FIRSTSTART' + stage])
+
+
 def to_result_list(competition, categories, stage):
     """
     Args:
@@ -88,17 +139,18 @@ def to_result_list(competition, categories, stage):
     Returns:
         iof.ResultList
     """
-    start_time = competition['DATE' + stage] + timedelta(seconds=competition['FIRSTSTART' + stage])
-    x_start_time = DateAndOptionalTime.Factory(
+    iof = bindings()
+    start_time = competition_start(competition, stage)
+    x_start_time = iof.DateAndOptionalTime.Factory(
         Date=start_time.date().isoformat(), Time=start_time.time().isoformat() + "+02:00")
-    x_event = Event.Factory(Name=competition['COMPETITIONNAME'], StartTime=x_start_time)
+    x_event = iof.Event.Factory(Name=competition['COMPETITIONNAME'], StartTime=x_start_time)
 
-    x_result_list = ResultList()
+    x_result_list = iof.ResultList()
     x_result_list.iofVersion = "3.0"
     x_result_list.Event = x_event
     x_result_list.createTime = datetime.now().isoformat() + "+02:00"
-    x_result_list.creator = "OEVENT2XML v0.1"
-    x_result_list.status = STD_ANON.Snapshot
+    x_result_list.creator = CREATOR
+    x_result_list.status = 'Snapshot'
 
     for _, category in categories.items():
         x_result_list.ClassResult.append(to_class_result(category, start_time, stage))
@@ -106,15 +158,17 @@ def to_result_list(competition, categories, stage):
     return x_result_list
 
 
-def to_xml(conn_fb, conn_sql, stage='1'):
+def load_categories(conn_fb, conn_sql, stage='1'):
     """
-    Connects to the db, retrieves competition data and generates IOF v3 ResultList xml
-
+    Args:
+        conn_fb: OEVENT db connection or snapshot
+        conn_sql: punches db connection
+        stage: competition stage
     Returns:
-        str: results in IOF v3 xml format
+        tuple: competition data, dict of category id -> competitors with their finish punch as SPLITTIME
     """
-    competition = get_table(conn_fb, 'OEVCOMPETITION')[0]
-    competitors = get_table(conn_fb, 'OEVLISTSVIEW')
+    competition = get_table(conn_fb, 'OEVCOMPETITION', columns=competition_columns(stage))[0]
+    competitors = get_table(conn_fb, 'OEVLISTSVIEW', columns=competitor_columns(stage))
 
     categories = defaultdict(list)
 
@@ -126,23 +180,243 @@ def to_xml(conn_fb, conn_sql, stage='1'):
             if competitor['CHIPNUMBER' + stage] in punch_dict:
                 competitor['SPLITTIME'] = (0, punch_dict[competitor['CHIPNUMBER' + stage]])
             categories[competitor['CATEGORYID']].append(competitor)
+    return competition, categories
+
+
+def to_xml(conn_fb, conn_sql, stage='1', class_cache=None):
+    """
+    Connects to the db, retrieves competition data and generates IOF v3 ResultList xml
+
+    Args:
+        class_cache: dict kept between calls, when given only ClassResults whose competitors
+            or finish punches changed since the previous call are serialised again
+    Returns:
+        str: results in IOF v3 xml format
+    """
+    competition, categories = load_categories(conn_fb, conn_sql, stage)
+
+    if class_cache is not None:
+        return to_xml_incremental(competition, categories, stage, class_cache)
 
     x_result_list = to_result_list(competition, categories, stage)
 
     return x_result_list.toxml("utf-8")
 
 
-def punch_xml(conn, chip_number, station_code, time, stage='1'):
-    competitors = get_competitor_by_chip_number(conn, chip_number, stage)
-    competition = get_table(conn, "OEVCOMPETITION")[0]
+def to_xml_incremental(competition, categories, stage, class_cache):
+    """
+    Generates ResultList xml from serialised ClassResults cached in `class_cache` by category id,
+    together with a fingerprint of the data they were built from.
+    """
+    start_time = competition_start(competition, stage)
+    fragments = []
+    rebuilt = 0
+    for category_id, category in categories.items():
+        fingerprint = class_fingerprint(category, start_time)
+        cached = class_cache.get(category_id)
+        if cached is None or cached[0] != fingerprint:
+            cached = class_cache[category_id] = (fingerprint, class_result_xml(category, start_time, stage))
+            rebuilt += 1
+        fragments.append(cached[1])
+    for category_id in set(class_cache) - set(categories):
+        del class_cache[category_id]
+    print("Rebuilt {} of {} classes".format(rebuilt, len(categories)))
+
+    envelope = to_result_list(competition, {}, stage).toxml("utf-8")
+    end = envelope.rindex(b'</ResultList>')
+    return envelope[:end] + b''.join(fragments) + envelope[end:]
+
+
+def class_fingerprint(category, start_time):
+    """ Changes whenever the ClassResult of `category` would change """
+    return start_time, tuple(tuple(sorted(competitor.items())) for competitor in category)
+
+
+def class_result_xml(category, start_time, stage):
+    """ ClassResult element without xml declaration and namespace, to be placed in a ResultList. """
+    xml = to_class_result(category, start_time, stage).toxml("utf-8", element_name='ClassResult')
+    xml = xml[xml.index(b'<ClassResult'):]
+    return xml.replace(b' xmlns="' + IOF_NAMESPACE.encode('utf-8') + b'"', b'', 1)
+
+
+def punch_categories(conn, chip_number, station_code, time, stage, competitors):
+    if competitors is None:
+        competitors = get_competitor_by_chip_number(conn, chip_number, stage)
+    competition = get_table(conn, "OEVCOMPETITION", columns=competition_columns(stage))[0]
 
     categories = defaultdict(list)
 
     for competitor in competitors:
         if (not competitor['ISVACANT']) and competitor['ISRUNNING' + stage]:
-            competitor['SPLITTIME'] = (station_code, time)
-            categories[competitor['CATEGORYID']].append(competitor)
+            categories[competitor['CATEGORYID']].append(dict(competitor, SPLITTIME=(station_code, time)))
+    return competition, categories
+
+
+def punch_xml(conn, chip_number, station_code, time, stage='1', competitors=None):
+    """
+    Generates IOF v3 ResultList xml with a single split or finish time
+
+    Args:
+        competitors: OEVENT rows for `chip_number`, looked up in the db when not given
+    Returns:
+        str: results in IOF v3 xml format
+    """
+    competition, categories = punch_categories(conn, chip_number, station_code, time, stage, competitors)
 
     x_result_list = to_result_list(competition, categories, stage)
 
     return x_result_list.toxml("utf-8")
+
+
+def class_result_lists(competition, categories, stage='1', executor=None, writer='pyxb'):
+    """
+    Generates a separate ResultList xml for each category.
+
+    PyXB serialisation is CPU bound and holds the GIL, with a `concurrent.futures.ProcessPoolExecutor`
+    as `executor` categories are serialised in parallel by its worker processes.
+
+    Args:
+        writer: 'pyxb' or 'stream'
+    Returns:
+        dict: category id -> (ResultList xml, seconds spent serialising it)
+    """
+    jobs = [(BINDINGS, writer, competition, category_id, category, stage)
+            for category_id, category in categories.items()]
+    documents = executor.map(class_result_list, jobs) if executor else map(class_result_list, jobs)
+    return dict(zip(categories, documents))
+
+
+def class_result_list(job):
+    """ ResultList xml of one category, runs in a worker process of `class_result_lists`. """
+    global BINDINGS
+    BINDINGS, writer, competition, category_id, category, stage = job
+    start = timer()
+    if writer == 'stream':
+        out = BytesIO()
+        write_result_list(out, competition, {category_id: category}, stage)
+        xml = out.getvalue()
+    else:
+        xml = to_result_list(competition, {category_id: category}, stage).toxml("utf-8")
+    return xml, timer() - start
+
+
+def punch_fragments(conn, chip_number, station_code, time, stage='1', competitors=None):
+    """
+    PersonResult xml with a single split or finish time for each runner with `chip_number`,
+    written by the streaming writer without namespace declaration.
+
+    Returns:
+        list: (category name, PersonResult xml) tuples
+    """
+    competition, categories = punch_categories(conn, chip_number, station_code, time, stage, competitors)
+    start_time = competition_start(competition, stage)
+    return [(competitor['CATEGORYNAME'], person_result_xml(competitor, start_time, stage))
+            for category in categories.values() for competitor in category]
+
+
+def write_xml(out, conn_fb, conn_sql, stage='1'):
+    """ Same as `to_xml`, written to the binary file object `out` by the streaming writer. """
+    competition, categories = load_categories(conn_fb, conn_sql, stage)
+    write_result_list(out, competition, categories, stage)
+
+
+def write_punch_xml(out, conn, chip_number, station_code, time, stage='1', competitors=None):
+    """ Same as `punch_xml`, written to the binary file object `out` by the streaming writer. """
+    competition, categories = punch_categories(conn, chip_number, station_code, time, stage, competitors)
+    write_result_list(out, competition, categories, stage)
+
+
+def write_result_list(out, competition, categories, stage):
+    """
+    Streaming counterpart of `to_result_list`, writes IOF v3 ResultList xml to `out` without building PyXB objects.
+
+    Output is the same as PyXB serialisation of `to_result_list`: elements in schema order,
+    times converted to UTC and doubles written with `repr`. Each PersonResult is written as soon as
+    it is formatted, so memory use does not grow with the size of the event.
+
+    Args:
+        out: binary file object, e.g. an open file or `socket.makefile('wb')`
+        competition: competition data from OEVENT db
+        categories: competitors data from OEVENT db
+        stage: competition stage
+    """
+    start_time = competition_start(competition, stage)
+    out.write('<?xml version="1.0" encoding="utf-8"?>'
+              '<ResultList createTime="{}" creator="{}" iofVersion="3.0" status="Snapshot" xmlns="{}">'
+              '<Event>{}<StartTime><Date>{}</Date><Time>{}</Time></StartTime></Event>'
+              .format(xml_datetime(datetime.now()), escape(CREATOR), IOF_NAMESPACE,
+                      xml_element('Name', competition['COMPETITIONNAME']),
+                      start_time.date().isoformat(), xml_time(start_time)).encode('utf-8'))
+
+    for _, category in categories.items():
+        out.write('<ClassResult><Class>{}{}</Class>'.format(
+            xml_element('Name', category[0]['CATEGORYNAME']),
+            xml_element('ShortName', category[0]['CATEGORYNAME'])).encode('utf-8'))
+        for competitor in category:
+            out.write(person_result_xml(competitor, start_time, stage).encode('utf-8'))
+        out.write(b'</ClassResult>')
+    out.write(b'</ResultList>')
+
+
+def person_result_xml(competitor, start_time, stage):
+    start, running_time, status, split = race_result(competitor, start_time, stage)
+    parts = ['<PersonResult><Person><Name>',
+             xml_element('Family', competitor['LASTNAME']),
+             xml_element('Given', competitor['FIRSTNAME']),
+             '</Name></Person>']
+    if competitor['CLUBLONGNAME']:
+        parts += ['<Organisation>',
+                  xml_element('Name', competitor['CLUBLONGNAME']),
+                  xml_element('ShortName', competitor['CLUBSHORTNAME']),
+                  '</Organisation>']
+    parts += ['<Result><StartTime>', xml_datetime(start), '</StartTime>']
+    if running_time is not None:
+        parts += ['<Time>', repr(float(running_time)), '</Time>']
+    parts += ['<Status>', STATUS_NAMES[status], '</Status>']
+    if split is not None:
+        parts += ['<SplitTime>', xml_element('ControlCode', split[0]),
+                  '<Time>', repr(float(split[1])), '</Time></SplitTime>']
+    parts.append('</Result></PersonResult>')
+    return ''.join(parts)
+
+
+def xml_element(name, value):
+    """ Element with escaped text, omitted when `value` is None. """
+    if value is None:
+        return ''
+    return '<{0}>{1}</{0}>'.format(name, escape(str(value), {'"': '&quot;'}))
+
+
+def xml_datetime(value):
+    """ Local OEVENT time as xs:dateTime in UTC """
+    iso = (value - UTC_OFFSET).isoformat()
+    if '.' in iso:
+        iso = iso.rstrip('0')
+    return iso + 'Z'
+
+
+def xml_time(value):
+    """ Local OEVENT time of day as xs:time in UTC """
+    iso = (value - UTC_OFFSET).time().isoformat()
+    if '.' in iso:
+        iso = iso.rstrip('0')
+    return iso + 'Z'
+
+
+def check_result_list(competition, categories, stage='1'):
+    """
+    Conformance check of the streaming writer against the PyXB bindings.
+
+    Streamed xml is parsed and validated with the IOF bindings, serialised again and compared
+    with the serialisation of `to_result_list`, ignoring createTime.
+
+    Returns:
+        bool: True when both writers produce the same document
+    Raises:
+        pyxb.PyXBException: streamed xml does not conform to the IOF schema
+    """
+    out = BytesIO()
+    write_result_list(out, competition, categories, stage)
+    streamed = bindings().CreateFromDocument(out.getvalue()).toxml("utf-8")
+    expected = to_result_list(competition, categories, stage).toxml("utf-8")
+    return CREATE_TIME.sub(b'', streamed) == CREATE_TIME.sub(b'', expected)
@@ -0,0 +1,160 @@
+""" Firebird connection pool """
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """ No connection became available within the checkout timeout. """
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of database connections shared by request handlers, workers and CLI commands.
+
+    Connections idle for longer than `check_after` seconds are tested with `check` before they are handed out,
+    connections older than `max_lifetime` seconds are closed when they are returned.
+    Broken connections are dropped and replaced with new ones.
+    """
+
+    def __init__(self, connect, check, max_size=8, timeout=5, max_lifetime=1800, check_after=30):
+        """
+        Args:
+            connect: callable returning a new connection
+            check: callable raising an exception when given connection is not usable
+            max_size: maximum number of open connections
+            timeout: seconds to wait for a free connection
+            max_lifetime: seconds after which a connection is reopened
+            check_after: seconds of idle time after which a connection is checked
+        """
+        self.connect = connect
+        self.check = check
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+        self._idle = []  # (connection, created, last used)
+        self._in_use = {}  # id(connection) -> created
+        self._opening = 0
+        self._condition = threading.Condition()
+        self.created = 0
+        self.discarded = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+
+    def acquire(self):
+        """
+        Returns:
+            connection
+        Raises:
+            PoolTimeout: all connections are in use for longer than `timeout`
+        """
+        start = time.monotonic()
+        while True:
+            entry = self._checkout(start)
+            if entry is None:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self._condition:
+                        self._opening -= 1
+                        self._condition.notify()
+                    raise
+                created = time.monotonic()
+                self.created += 1
+                break
+
+            conn, created, last_used = entry
+            if time.monotonic() - last_used < self.check_after:
+                break
+            try:
+                self.check(conn)
+                break
+            except Exception as exception:
+                print("Dropping broken DB connection: ", exception)
+                self._close(conn)
+                with self._condition:
+                    self._opening -= 1
+
+        with self._condition:
+            self._opening -= 1
+            self._in_use[id(conn)] = created
+        return conn
+
+    def _checkout(self, start):
+        """ Return an idle entry, or None after reserving a slot for a new connection. """
+        with self._condition:
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    self._opening += 1
+                    self._account(start)
+                    return entry
+                if len(self._in_use) + self._opening < self.max_size:
+                    self._opening += 1
+                    self._account(start)
+                    return None
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout('No free DB connection after {}s'.format(self.timeout))
+                self._condition.wait(remaining)
+
+    def _account(self, start):
+        waited = time.monotonic() - start
+        self.checkouts += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+
+    def release(self, conn):
+        """ Return `conn` to the pool, its transaction is rolled back. """
+        with self._condition:
+            created = self._in_use.pop(id(conn))
+        try:
+            conn.rollback()
+            reuse = time.monotonic() - created < self.max_lifetime
+        except Exception as exception:
+            print("Dropping broken DB connection: ", exception)
+            reuse = False
+        if not reuse:
+            self._close(conn)
+        with self._condition:
+            if reuse:
+                self._idle.append((conn, created, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def _close(self, conn):
+        self.discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """ Close all idle connections. """
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        return {'size': self.max_size,
+                'inUse': len(self._in_use),
+                'idle': len(self._idle),
+                'created': self.created,
+                'discarded': self.discarded,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'waitTime': self.wait_time,
+                'maxWaitTime': self.max_wait_time}
@@ -0,0 +1,404 @@
+""" Background workers """
+
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+INSERT_PUNCH = '''INSERT OR REPLACE INTO punches(chipNumber, stationCode, time, stage) VALUES (?,?,?,?)'''
+
+
+class PendingWrite(object):
+    """ Rows queued for the punch writer, can be waited on until they are committed. """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        """
+        Args:
+            timeout: seconds to wait for the commit
+        Returns:
+            bool: True when committed, False on timeout
+        Raises:
+            Exception: error raised while writing the rows
+        """
+        if not self.done.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+class PunchWriter(object):
+    """
+    Writes punches to sqlite from a single background thread.
+
+    Queued rows are group-committed in one transaction every `interval` seconds,
+    or as soon as `batch_size` rows are waiting.
+    """
+
+    def __init__(self, database, interval=0.05, batch_size=500, queue_size=10000):
+        self.database = database
+        self.interval = interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.commits = 0
+        self.rows = 0
+        self.failed = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='punch-writer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        """ Commit everything that is still queued and stop the writer thread. """
+        with self._lock:
+            if self._thread is None:
+                return
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, rows, timeout=None):
+        """
+        Args:
+            rows: (chipNumber, stationCode, time, stage) tuples
+            timeout: seconds to wait for a free slot in the queue
+        Returns:
+            PendingWrite
+        Raises:
+            queue.Full: writer is not keeping up
+        """
+        pending = PendingWrite(rows)
+        self.queue.put(pending, timeout=timeout)
+        return pending
+
+    def _run(self):
+        conn = sqlite3.connect(self.database)
+        running = True
+        while running:
+            first = self.queue.get()
+            if first is None:
+                break
+            batch = [first]
+            size = len(first.rows)
+            deadline = time.monotonic() + self.interval
+            while size < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if pending is None:
+                    running = False
+                    break
+                batch.append(pending)
+                size += len(pending.rows)
+            self._commit(conn, batch)
+        conn.close()
+
+    def _commit(self, conn, batch):
+        try:
+            self._write(conn, batch)
+            errors = [None] * len(batch)
+        except Exception as exception:
+            print("Punch commit failed: ", exception)
+            if len(batch) > 1:
+                # one bad write must not fail punches of other requests committed with it
+                errors = [self._write_single(conn, pending) for pending in batch]
+            else:
+                self.failed += 1
+                errors = [exception]
+        for pending, error in zip(batch, errors):
+            pending.error = error
+            pending.done.set()
+
+    def _write_single(self, conn, pending):
+        try:
+            self._write(conn, [pending])
+        except Exception as exception:
+            print("Punch write failed: ", pending.rows, exception)
+            self.failed += 1
+            return exception
+        return None
+
+    def _write(self, conn, batch):
+        try:
+            conn.executemany(INSERT_PUNCH, (row for pending in batch for row in pending.rows))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        self.commits += 1
+        self.rows += sum(len(pending.rows) for pending in batch)
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'commits': self.commits, 'rows': self.rows, 'failed': self.failed}
+
+
+class ExportPool(object):
+    """
+    Runs `handler` for queued jobs on a pool of `workers` background threads.
+
+    Jobs with the same `key`, e.g. the file they write, are collapsed: a job submitted while an older one
+    with its key is still queued replaces it, so the queue is bounded by the number of distinct keys and
+    `submit` never blocks or drops a job. Jobs of a key are handled one at a time, in order.
+
+    Failed jobs are retried `retries` times. `stop` waits until every queued job is handled,
+    so nothing that was accepted is lost on a clean shutdown.
+    """
+
+    def __init__(self, handler, workers=2, key=None, retries=3, retry_wait=1):
+        """
+        Args:
+            key: callable returning the key of a job, by default no jobs are collapsed
+        """
+        self.handler = handler
+        self.workers = workers
+        self.key = key or id
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.exported = 0
+        self.failed = 0
+        self.collapsed = 0
+        self.last_lag = 0
+        self.max_lag = 0
+        self._pending = OrderedDict()  # key -> (job, time queued), oldest first
+        self._running = set()
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._run, name='xml-export-%d' % i)
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+
+    def stop(self):
+        """ Handle all queued jobs and stop the worker threads. """
+        with self._lock:
+            with self._condition:
+                self._stopping = True
+                self._condition.notify_all()
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+            self._stopping = False
+
+    def submit(self, job):
+        """ Queue `job` in place of a queued job with the same key, never blocks. """
+        key = self.key(job)
+        with self._condition:
+            if key in self._pending:
+                self.collapsed += 1
+                queued = self._pending[key][1]  # lag is counted from the oldest collapsed job
+                self._pending[key] = (job, queued)
+            else:
+                self._pending[key] = (job, time.monotonic())
+            self._condition.notify()
+
+    def _next(self):
+        """ Oldest queued job whose key is not being handled, None when all are done and the pool stops. """
+        with self._condition:
+            while True:
+                for key in self._pending:
+                    if key not in self._running:
+                        job, queued = self._pending.pop(key)
+                        self._running.add(key)
+                        return key, job, queued
+                if self._stopping and not self._pending:
+                    return None
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                break
+            key, job, queued = item
+            try:
+                self._handle(job)
+            finally:
+                with self._condition:
+                    self._running.discard(key)
+                    self._condition.notify_all()
+            self.last_lag = time.monotonic() - queued
+            self.max_lag = max(self.max_lag, self.last_lag)
+
+    def _handle(self, job):
+        for attempt in range(self.retries + 1):
+            try:
+                self.handler(job)
+            except Exception as exception:
+                print("Export failed: ", exception)
+                if attempt < self.retries:
+                    time.sleep(self.retry_wait)
+                else:
+                    self.failed += 1
+            else:
+                self.exported += 1
+                break
+
+    def stats(self):
+        return {'queued': len(self._pending),
+                'workers': len(self._threads),
+                'exported': self.exported,
+                'failed': self.failed,
+                'collapsed': self.collapsed,
+                'lastLag': self.last_lag,
+                'maxLag': self.max_lag}
+
+
+class ExportScheduler(object):
+    """
+    Runs `export` in a background thread after `trigger` calls.
+
+    Bursts of triggers are debounced: export starts once no trigger arrived for `debounce` seconds,
+    but at latest `max_latency` seconds after the first one. When `fingerprint` returns the same value
+    as for the last successful export, the export is skipped.
+    """
+
+    def __init__(self, export, fingerprint=None, debounce=1, max_latency=5):
+        self.export = export
+        self.fingerprint = fingerprint
+        self.debounce = debounce
+        self.max_latency = max_latency
+        self.triggers = 0
+        self.exports = 0
+        self.skipped = 0
+        self.failed = 0
+        self._first = None
+        self._last = None
+        self._exported = None
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='export-scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def trigger(self):
+        with self._condition:
+            self.triggers += 1
+            self._last = time.monotonic()
+            if self._first is None:
+                self._first = self._last
+            self._condition.notify()
+
+    def _wait(self):
+        with self._condition:
+            while self._first is None:
+                self._condition.wait()
+            while True:
+                deadline = min(self._last + self.debounce, self._first + self.max_latency)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            self._first = self._last = None
+
+    def _run(self):
+        while True:
+            self._wait()
+            try:
+                fingerprint = self.fingerprint() if self.fingerprint else None
+                if fingerprint is not None and fingerprint == self._exported:
+                    self.skipped += 1
+                    continue
+                self.export()
+                self.exports += 1
+                self._exported = fingerprint
+            except Exception as exception:
+                print("Failed during update: ", exception)
+                self.failed += 1
+                time.sleep(self.max_latency)
+                self.trigger()
+
+    def stats(self):
+        return {'triggers': self.triggers, 'exports': self.exports, 'skipped': self.skipped, 'failed': self.failed}
+
+
+class Coalescer(object):
+    """
+    Batches items emitted to the same room.
+
+    The first item for an (event, room) opens a window of `window` seconds, items added during the window
+    are emitted together as one list. A batch reaching `max_batch` items is emitted immediately.
+    """
+
+    def __init__(self, emit, window=0.1, max_batch=100):
+        """
+        Args:
+            emit: callable(event, items, room)
+            window: seconds items are collected
+            max_batch: maximal number of items in one emit
+        """
+        self.emit = emit
+        self.window = window
+        self.max_batch = max_batch
+        self.items = 0
+        self.batches = 0
+        self.largest = 0
+        self._batches = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='coalescer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def add(self, event, room, item):
+        full = None
+        with self._condition:
+            self.items += 1
+            batch = self._batches.setdefault((event, room), [])
+            batch.append(item)
+            if len(batch) >= self.max_batch:
+                full = self._batches.pop((event, room))
+            elif len(self._batches) == 1 and len(batch) == 1:
+                self._condition.notify()
+        if full is not None:
+            self._emit(event, room, full)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._batches:
+                    self._condition.wait()
+            time.sleep(self.window)
+            with self._condition:
+                batches, self._batches = self._batches, {}
+            for (event, room), items in batches.items():
+                self._emit(event, room, items)
+
+    def _emit(self, event, room, items):
+        self.batches += 1
+        self.largest = max(self.largest, len(items))
+        try:
+            self.emit(event, items, room)
+        except Exception as exception:
+            print("Emit failed: ", exception)
+
+    def stats(self):
+        return {'items': self.items, 'batches': self.batches, 'largestBatch': self.largest}